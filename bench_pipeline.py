@@ -0,0 +1,96 @@
+import hardware
+hardware.use_backend('sim')
+
+import argparse
+import asyncio
+import tempfile
+import threading
+import time
+import os
+
+import sim
+import sensor
+import oled
+import camera
+import servo
+import classify
+import prediction_log
+import metrics
+from main import Pipeline
+
+# Put the next item on the platform every time the bin is ready for it
+def feed_items(world, n_items, arrival_delay, stop):
+    while world.n_placed < n_items and not stop.is_set():
+        if world.ready_for_item():
+            time.sleep(arrival_delay)
+            world.place_item()
+        time.sleep(0.01)
+
+def print_report(pipeline):
+    print(pipeline.tracer.report())
+    print(f"{pipeline.n_items} items, {pipeline.items_per_minute():.2f} items/min")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run the main loop on simulated hardware")
+    parser.add_argument("--items", type = int, default = 10)
+    parser.add_argument("--arrival-delay", type = float, default = 0.0, help = "Seconds between bin ready and next item")
+    parser.add_argument("--img-path", default = "images")
+    parser.add_argument("--csv-path", default = "img_metadata.csv", help = "Recorded predictions for the simulated classifier")
+    parser.add_argument("--model-path", default = "model")
+    parser.add_argument("--sim-classifier", action = "store_true", help = "Replay recorded predictions instead of running the model")
+    parser.add_argument("--scheduler", action = argparse.BooleanOptionalAction, default = True, help = "Skip bottom servo moves the next item doesn't need")
+    parser.add_argument("--metrics-path", default = None, help = "Write Prometheus metrics here after every item")
+    parser.add_argument("--trace", default = None, help = "Recorded distance readings, one per line")
+    args = parser.parse_args()
+
+    world = sim.world
+    world.img_path = args.img_path
+    world.csv_path = args.csv_path
+    if args.trace:
+        world.load_trace(args.trace)
+
+    dump_trash = servo.DumpTrash()
+    dist_sensor = sensor.DistanceSensor()
+    ir_sensor = sensor.IRSensor()
+    picam = camera.Camera()
+    oled_screen = oled.Oled()
+    has_model = os.path.exists(args.model_path) and any(name.endswith(".tflite") for name in os.listdir(args.model_path))
+    if args.sim_classifier or not has_model:
+        print("Using recorded predictions")
+        img_classifier = sim.SimClassifier(args.csv_path)
+    else:
+        img_classifier = classify.ImageClassifier(path = args.model_path)
+    picam.start_frame_buffer()
+    preprocessor = classify.ArrayPreprocessor(img_classifier.get_input_shape(), picam.array_color("main"), picam.array_size("main"))
+
+    dist_sensor.enable_edge_timing()
+    watcher = sensor.ObjectWatcher(dist_sensor, ir_sensor)
+    watcher.add_activity_listener(picam.set_frame_buffer_active)
+
+    tracer = metrics.Tracer()
+    with tempfile.TemporaryDirectory() as result_path:
+        log = prediction_log.PredictionLog(f"{result_path}/predictions.db")
+        writer = prediction_log.PredictionWriter(log, f"{result_path}/images", tracer = tracer)
+        dump_scheduler = servo.DumpScheduler(dump_trash) if args.scheduler else dump_trash
+        pipeline = Pipeline(dump_scheduler, dist_sensor, watcher, picam, oled_screen, img_classifier, preprocessor, writer,
+                            tracer = tracer, metrics_path = args.metrics_path,
+                            retrigger_cache = classify.InferenceCache(capacity = 1, max_distance = 0))
+
+        stop = threading.Event()
+        feeder = threading.Thread(target = feed_items, args = (world, args.items, args.arrival_delay, stop), daemon = True)
+        feeder.start()
+        try:
+            asyncio.run(pipeline.run(max_items = args.items))
+        finally:
+            stop.set()
+            watcher.stop()
+            writer.close()
+            log.close()
+
+    print_report(pipeline)
+    print(f"{world.n_dropped} items dropped")
+    if args.scheduler:
+        print(f"Bottom servo moves {dump_scheduler.n_bottom_moves}, skipped {dump_scheduler.n_bottom_skipped}")
+
+if __name__ == "__main__":
+    main()
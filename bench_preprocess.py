@@ -0,0 +1,67 @@
+from PIL import Image
+import numpy as np
+import argparse
+import time
+import os
+import cv2
+
+import classify
+
+# Load saved images and scale them up to look like camera frames
+def load_frames(img_path, capture_size, limit = None):
+    names = sorted(name for name in os.listdir(img_path) if name.endswith((".jpeg", ".jpg")))
+    if limit:
+        names = names[:limit]
+    frames = []
+    for name in names:
+        with Image.open(f"{img_path}/{name}") as image:
+            frames.append(np.asarray(image.convert('RGB').resize(capture_size)))
+    return frames
+
+# Run fn on every frame, return time per frame in ms
+def time_per_frame(fn, frames, repeat = 3):
+    times = []
+    for _ in range(repeat):
+        for frame in frames:
+            time1 = time.perf_counter()
+            fn(frame)
+            time2 = time.perf_counter()
+            times.append((time2 - time1) * 1000)
+    return np.median(times), np.percentile(times, 95)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare PIL and array preprocessing")
+    parser.add_argument("--img-path", default = "images")
+    parser.add_argument("--capture-size", type = int, default = 1080)
+    parser.add_argument("--input-size", type = int, default = 224)
+    parser.add_argument("--limit", type = int, default = None)
+    parser.add_argument("--repeat", type = int, default = 3)
+    args = parser.parse_args()
+
+    capture_size = (args.capture_size, args.capture_size)
+    size = (args.input_size, args.input_size)
+    frames = load_frames(args.img_path, capture_size, args.limit)
+    print(f"{len(frames)} frames of {capture_size} to {size}")
+
+    # Same frames in the YUV420 layout of the lores stream
+    yuv_frames = [cv2.cvtColor(frame, cv2.COLOR_RGB2YUV_I420) for frame in frames]
+
+    # Current path : capture_img gives PIL image, main converts then crops + thumbnail
+    def pil_path(frame):
+        return classify.preprocess_img(Image.fromarray(frame).convert('RGB'), size)
+
+    rgb_preprocessor = classify.ArrayPreprocessor(size, 'RGB')
+    yuv_preprocessor = classify.ArrayPreprocessor(size, 'YUV420')
+
+    results = {
+        'PIL crop + thumbnail' : time_per_frame(pil_path, frames, args.repeat),
+        'Array RGB' : time_per_frame(rgb_preprocessor.process, frames, args.repeat),
+        'Array YUV420' : time_per_frame(yuv_preprocessor.process, yuv_frames, args.repeat),
+        }
+
+    baseline = results['PIL crop + thumbnail'][0]
+    for name, (p50, p95) in results.items():
+        print(f"{name:<22} p50 {p50:7.3f} ms  p95 {p95:7.3f} ms  speedup x{baseline / p50:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import hardware
+hardware.use_backend('sim')
+
+from PIL import Image
+import numpy as np
+import subprocess
+import argparse
+import platform
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+import classify
+import prediction_log
+from main import save_prediction_result
+
+BENCHMARKS = ['preprocess', 'array_preprocess', 'inference', 'save']
+
+# Saved corpus scaled up to look like camera captures, loaded once before any timing
+def load_images(img_path, capture_size, limit = None):
+    names = sorted(name for name in os.listdir(img_path) if name.endswith((".jpeg", ".jpg")))
+    if limit:
+        names = names[:limit]
+    images = []
+    for name in names:
+        with Image.open(f"{img_path}/{name}") as image:
+            image = image.convert('RGB')
+            if capture_size:
+                image = image.resize(capture_size)
+            images.append(image)
+    return images
+
+# Call fn on every input, repeat times after warmup calls, returns latency of every call in seconds
+def run_timed(fn, inputs, repeat, warmup):
+    for i in range(min(warmup, len(inputs))):
+        fn(inputs[i])
+    times = []
+    for _ in range(repeat):
+        for value in inputs:
+            time1 = time.perf_counter()
+            fn(value)
+            times.append(time.perf_counter() - time1)
+    return np.array(times)
+
+def summarize(times):
+    p50, p95, p99 = np.percentile(times, [50, 95, 99])
+    return {
+        'n' : int(len(times)),
+        'throughput' : float(len(times) / times.sum()),
+        'p50_ms' : float(p50 * 1000),
+        'p95_ms' : float(p95 * 1000),
+        'p99_ms' : float(p99 * 1000),
+        'max_ms' : float(times.max() * 1000),
+        }
+
+# Tiny random classifier with the same input and output as the real one, same weights every time
+def generate_model(model_dir, label_path, size):
+    import tensorflow as tf
+    n_classes = len(classify.load_labels(label_path))
+    tf.random.set_seed(0)
+    model = tf.keras.Sequential([
+        tf.keras.Input((size, size, 3)),
+        tf.keras.layers.Conv2D(8, 3, strides = 2, activation = 'relu'),
+        tf.keras.layers.Conv2D(16, 3, strides = 2, activation = 'relu'),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(n_classes, activation = 'softmax'),
+        ])
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    with open(f"{model_dir}/generated.tflite", 'wb') as f:
+        f.write(converter.convert())
+
+# Model folder to benchmark : model_path if it has weights, otherwise a generated model next to its labels
+def prepare_model(model_path, work_dir, size):
+    if any(name.endswith(".tflite") for name in os.listdir(model_path)):
+        return model_path, False
+    model_dir = f"{work_dir}/model"
+    os.makedirs(model_dir)
+    for name in ("labelmap.txt", "category.txt"):
+        shutil.copy(f"{model_path}/{name}", model_dir)
+    generate_model(model_dir, f"{model_dir}/labelmap.txt", size)
+    return model_dir, True
+
+def bench_preprocess(images, size, args):
+    return run_timed(lambda image: classify.preprocess_img(image, size), images, args.repeat, args.warmup)
+
+# Camera path of the main loop : RGB capture array straight to model input, no PIL
+def bench_array_preprocess(images, size, args):
+    preprocessor = classify.ArrayPreprocessor(size)
+    inputs = [np.asarray(image) for image in images]
+    return run_timed(preprocessor.process, inputs, args.repeat, args.warmup)
+
+def bench_inference(images, size, args, work_dir):
+    model_dir, generated = prepare_model(args.model_path, work_dir, args.input_size)
+    print(f"Inference with {'generated model' if generated else model_dir}")
+    # ImageClassifier doesn't raise without an interpreter, ask for it here so main() can skip
+    classify.load_interpreter()
+    img_classifier = classify.ImageClassifier(path = model_dir)
+    inputs = [np.asarray(classify.preprocess_img(image.copy(), size)) for image in images]
+    times = run_timed(img_classifier.predict_image, inputs, args.repeat, args.warmup)
+    return times, generated
+
+def bench_save(images, size, args, work_dir):
+    # Same work as one item of the main loop : jpeg encode + log row, on local disk
+    log = prediction_log.PredictionLog(f"{work_dir}/predictions.db")
+    img_path = f"{work_dir}/images"
+    result = {'category' : "Residu", 'sub_category' : "Plastic", 'probability' : 0.5, 'time' : 0.1}
+    inputs = [classify.preprocess_img(image.copy(), size) for image in images]
+    try:
+        return run_timed(lambda image: save_prediction_result(image, result, log, img_path), inputs, args.repeat, args.warmup)
+    finally:
+        log.close()
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit' : commit,
+        'time' : time.strftime("%Y-%m-%d %H:%M:%S"),
+        'python' : platform.python_version(),
+        'machine' : platform.machine(),
+        'node' : platform.node(),
+        'numpy' : np.__version__,
+        }
+
+# Benchmarks slower than baseline by more than tolerance, compared on p50 and throughput
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None or base.get('generated_model') != result.get('generated_model'):
+            continue
+        if result['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{name} p50 {base['p50_ms']:.2f} ms > {result['p50_ms']:.2f} ms")
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f"{name} throughput {base['throughput']:.1f}/s > {result['throughput']:.1f}/s")
+    return regressions
+
+def print_results(results, baseline = None):
+    print(f"{'benchmark':<18}{'n':>6}{'items/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'base p50':>10}")
+    for name, result in results.items():
+        base = baseline['results'].get(name) if baseline else None
+        base_p50 = f"{base['p50_ms']:>10.2f}" if base else f"{'-':>10}"
+        print(f"{name:<18}{result['n']:>6}{result['throughput']:>10.1f}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}{base_p50}")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark preprocessing, inference and persistence on the images corpus")
+    parser.add_argument("--img-path", default = "images")
+    parser.add_argument("--model-path", default = "model")
+    parser.add_argument("--benchmarks", nargs = "+", default = BENCHMARKS, choices = BENCHMARKS)
+    parser.add_argument("--capture-size", type = int, default = 1080, help = "Scale corpus images to this size, 0 keeps them")
+    parser.add_argument("--input-size", type = int, default = 224)
+    parser.add_argument("--limit", type = int, default = None)
+    parser.add_argument("--repeat", type = int, default = 3)
+    parser.add_argument("--warmup", type = int, default = 5)
+    parser.add_argument("--baseline", default = "bench_baseline.json", help = "Compare with this baseline when it exists")
+    parser.add_argument("--save-baseline", nargs = "?", const = "bench_baseline.json", default = None,
+                        help = "Save results as the new baseline")
+    parser.add_argument("--tolerance", type = float, default = 0.15, help = "Allowed slowdown before failing")
+    args = parser.parse_args()
+
+    capture_size = (args.capture_size, args.capture_size) if args.capture_size else None
+    size = (args.input_size, args.input_size)
+    images = load_images(args.img_path, capture_size, args.limit)
+    print(f"{len(images)} images from {args.img_path}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        if 'preprocess' in args.benchmarks:
+            results['preprocess'] = summarize(bench_preprocess(images, size, args))
+        if 'array_preprocess' in args.benchmarks:
+            results['array_preprocess'] = summarize(bench_array_preprocess(images, size, args))
+        if 'inference' in args.benchmarks:
+            try:
+                times, generated = bench_inference(images, size, args, work_dir)
+            except ImportError as e:
+                print(f"Skipping inference, no interpreter or no model weights and can't generate one : {e}")
+            else:
+                results['inference'] = dict(summarize(times), generated_model = generated)
+        if 'save' in args.benchmarks:
+            results['save'] = summarize(bench_save(images, size, args, work_dir))
+
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'environment' : environment(), 'results' : results}, f, indent = 4)
+        print(f"Baseline saved to {args.save_baseline}")
+    elif baseline:
+        # Numbers from another machine say little, still compare but say so
+        if baseline['environment'].get('node') != platform.node():
+            print(f"Warning : baseline was made on {baseline['environment'].get('node')}, not on {platform.node()}")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression :", regression)
+        if regressions:
+            sys.exit(1)
+        print(f"No regression against {args.baseline} ({baseline['environment'].get('commit')})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import numpy as np
+import argparse
+import asyncio
+import json
+import time
+
+import hardware
+
+# Top servo modes tried for every direction, fastest first
+TOP_MODES = ['fast', 'slow', 'very_slow']
+DIRECTIONS = ['clockwise', 'counter']
+
+# Directions used by every dump position (top servo, bottom servo), same as DumpTrash._dump_trash_*
+# Front only turns the top servo back when it was pushed away while holding the trash
+POSITIONS = {
+    'front' : ('counter', 'clockwise'),
+    'front_left' : ('clockwise', 'counter'),
+    'front_right' : ('counter', None),
+    'back_left' : ('clockwise', None),
+    'back_right' : ('counter', 'counter'),
+    }
+
+# Wait until door sensor reads closed (True) or open (False), returns the time it happened or None
+async def wait_door(dump_trash, closed, timeout, refresh = 0.002):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while dump_trash.check_door_sensor() != closed:
+        if loop.time() > deadline:
+            return None
+        await asyncio.sleep(refresh)
+    return loop.time()
+
+# One revolution of the top servo from home, every time is in second from start
+# leave : platform out of door sensor range
+# back : door sensor closed again
+# total : stopped and confirmed at home, including the homing correction after an overshoot
+async def measure_revolution(dump_trash, direction, mode, timeout):
+    loop = asyncio.get_running_loop()
+    await dump_trash.top_servo_default_pos()
+
+    duty = dump_trash.top_servo_duty[f"{mode}_{direction}"]
+    start = loop.time()
+    dump_trash.change_duty_top_servo(duty)
+    leave = await wait_door(dump_trash, False, timeout)
+    back = None
+    if leave is not None:
+        back = await wait_door(dump_trash, True, timeout)
+    if back is None:
+        # Never left or never came back, stop and bring it home for the next run
+        await dump_trash.hard_stop_top_servo()
+        await dump_trash.top_servo_default_pos()
+        return None
+
+    await dump_trash.hard_stop_top_servo()
+    overshoot = not dump_trash.check_door_sensor()
+    await dump_trash.top_servo_default_pos()
+    return {
+        'leave' : leave - start,
+        'back' : back - start,
+        'total' : loop.time() - start,
+        'overshoot' : overshoot,
+        }
+
+# Time the platform takes to cross the door sensor range while spinning
+# Homing stops at the edge of the range, on the next dump the platform may have to cross all of it before leaving
+async def measure_window(dump_trash, direction, mode, timeout):
+    await dump_trash.top_servo_default_pos()
+    dump_trash.change_duty_top_servo(dump_trash.top_servo_duty[f"{mode}_{direction}"])
+    window = None
+    if await wait_door(dump_trash, False, timeout) is not None:
+        back = await wait_door(dump_trash, True, timeout)
+        if back is not None:
+            leave = await wait_door(dump_trash, False, timeout)
+            if leave is not None:
+                window = leave - back
+    await dump_trash.hard_stop_top_servo()
+    await dump_trash.top_servo_default_pos()
+    return window
+
+async def measure_top(dump_trash, modes, n_runs, timeout):
+    results = {}
+    for direction in DIRECTIONS:
+        for mode in modes:
+            runs = []
+            for _ in range(n_runs):
+                runs.append(await measure_revolution(dump_trash, direction, mode, timeout))
+            window = await measure_window(dump_trash, direction, mode, timeout)
+            results[f"{mode}_{direction}"] = {'runs' : runs, 'window' : window}
+            done = [run for run in runs if run is not None]
+            if done and window is not None:
+                print(f"{direction:<10}{mode:<10} leave {np.median([run['leave'] for run in done]):6.3f} s"
+                      f"  window {window:6.3f} s"
+                      f"  back {np.median([run['back'] for run in done]):6.3f} s"
+                      f"  total {np.median([run['total'] for run in done]):6.3f} s"
+                      f"  overshoot {sum(run['overshoot'] for run in done)}/{len(done)}  failed {len(runs) - len(done)}")
+            else:
+                print(f"{direction:<10}{mode:<10} failed")
+    return results
+
+# Top servo mode the profile uses in every direction, the slowest one if positions differ
+# Slow modes are hand picked to tip the trash, coming home doesn't say the trash fell
+def current_modes(profile):
+    modes = {}
+    for position, motion in profile['positions'].items():
+        direction = POSITIONS[position][0]
+        mode = motion['top_mode']
+        if direction not in modes or TOP_MODES.index(mode) > TOP_MODES.index(modes[direction]):
+            modes[direction] = mode
+    return modes
+
+# Fastest allowed mode of every direction that came back home on every run
+# Blind spin time must get the platform out of the door sensor range from anywhere inside it,
+# but stay well before it comes back
+def choose_top(results, allowed, margin):
+    choice = {}
+    for direction in DIRECTIONS:
+        best = None
+        for mode in allowed[direction]:
+            result = results.get(f"{mode}_{direction}")
+            if result is None or result['window'] is None:
+                continue
+            runs = result['runs']
+            if not runs or any(run is None for run in runs):
+                continue
+            total = float(np.median([run['total'] for run in runs]))
+            spin_time = max([run['leave'] for run in runs] + [result['window']]) * margin
+            if spin_time >= min(run['back'] for run in runs) / 2:
+                continue
+            if best is None or total < best['total']:
+                best = {
+                    'mode' : mode,
+                    'spin_time' : round(spin_time, 3),
+                    'total' : round(total, 3),
+                    'back' : max(run['back'] for run in runs),
+                    }
+        if best is None:
+            raise RuntimeError(f"No top servo mode came back home every time going {direction}")
+        choice[direction] = best
+    return choice
+
+# Bottom servo has no position feedback, travel time comes from the servo speed measured by the operator
+# Dwell keeps it there long enough for the trash to slide off
+def bottom_times(dump_trash, speed, margin, dwell):
+    default_duty = dump_trash.bottom_servo_duty['default']
+    times = {}
+    for direction in DIRECTIONS:
+        angle = abs(dump_trash.bottom_servo_duty[direction] - default_duty) / 10 * 180
+        times[direction] = round(angle / speed * margin + dwell, 3)
+    return times
+
+# Nothing measured, keep the bottom times of the profile
+def profile_bottom_times(profile):
+    import servo
+    times = {}
+    for position, motion in profile['positions'].items():
+        pose = servo.BOTTOM_POSE[position]
+        if pose != 'default' and 'bottom_time' in motion:
+            times[pose] = max(times.get(pose, 0), motion['bottom_time'])
+    return times
+
+# Homing after a dump turns at slow speed, stuck time has to cover a slow revolution too
+def longest_revolution(results, top):
+    backs = [choice['back'] for choice in top.values()]
+    for direction in DIRECTIONS:
+        result = results.get(f"slow_{direction}", {'runs' : []})
+        backs += [run['back'] for run in result['runs'] if run is not None]
+    return max(backs)
+
+# hold_time : front dump wait before checking the top servo, None follows the bottom time
+def make_profile(results, top, bottom, bottom_home_time, stuck_margin, hold_time = None):
+    positions = {}
+    expected = {}
+    for position, (top_direction, bottom_direction) in POSITIONS.items():
+        motion = {
+            'top_mode' : top[top_direction]['mode'],
+            'top_spin_time' : top[top_direction]['spin_time'],
+            }
+        top_time = top[top_direction]['total']
+        if bottom_direction is None:
+            expected[position] = top_time
+        else:
+            motion['bottom_time'] = bottom[bottom_direction]
+            if position == 'front':
+                # Top servo stays home, only check it once the chute has turned
+                motion['hold_time'] = bottom[bottom_direction] if hold_time is None else hold_time
+                expected[position] = motion['hold_time'] + bottom[bottom_direction]
+            else:
+                # Both servos move together, then the chute comes back
+                expected[position] = max(top_time, bottom[bottom_direction]) + bottom[bottom_direction]
+        positions[position] = motion
+
+    profile = {
+        'stuck_time' : round(longest_revolution(results, top) * stuck_margin, 3),
+        'bottom_home_time' : bottom_home_time,
+        'positions' : positions,
+        'calibrated' : time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+    return profile, expected
+
+async def calibrate(dump_trash, args):
+    # Slow modes may take longer than the usual stuck time, don't let unstuck kick in while measuring
+    dump_trash.stuck_time = args.timeout
+    await dump_trash.servo_default_pos()
+    # Slow is always measured, homing runs at slow speed and sets the stuck time
+    modes = [mode for mode in TOP_MODES if mode == 'slow' or any(mode in allowed for allowed in args.allowed.values())]
+    results = await measure_top(dump_trash, modes, args.runs, args.timeout)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = "Measure servo motion and write the motion profile of this unit")
+    parser.add_argument("--output", default = "servo_profile.json")
+    parser.add_argument("--sim", action = "store_true", help = "Calibrate the simulated servos")
+    parser.add_argument("--runs", type = int, default = 3, help = "Revolutions per mode and direction")
+    parser.add_argument("--modes", nargs = "+", default = None, choices = TOP_MODES,
+                        help = "Allow these top servo modes, fastest one that comes home every run is used. "
+                               "Default : keep the modes of the current profile, check a faster one really tips the trash before allowing it")
+    parser.add_argument("--timeout", type = float, default = 15.0, help = "Longest revolution before a mode counts as failed")
+    parser.add_argument("--spin-margin", type = float, default = 1.5)
+    parser.add_argument("--stuck-margin", type = float, default = 2.0)
+    parser.add_argument("--bottom-speed", type = float, default = None,
+                        help = "Bottom servo speed measured on this unit, degree per second. Default : keep the bottom times of the current profile")
+    parser.add_argument("--bottom-margin", type = float, default = 1.5)
+    parser.add_argument("--bottom-dwell", type = float, default = 0.5, help = "Seconds the chute stays turned")
+    args = parser.parse_args()
+
+    if args.sim:
+        hardware.use_backend('sim')
+    import servo
+
+    # Modes and bottom times that aren't measured come from the profile being replaced, or the hand-tuned one
+    current = servo.load_profile(args.output)
+    if args.modes:
+        args.allowed = {direction : args.modes for direction in DIRECTIONS}
+    else:
+        args.allowed = {direction : [mode] for direction, mode in current_modes(current).items()}
+    print("Top servo modes :", args.allowed)
+
+    # Start from hand-tuned values, not from the profile being replaced
+    dump_trash = servo.DumpTrash(home = False, profile_path = None)
+    try:
+        results = asyncio.run(calibrate(dump_trash, args))
+    finally:
+        dump_trash.shutdown_servo()
+
+    top = choose_top(results, args.allowed, args.spin_margin)
+    if args.bottom_speed is None:
+        # Bottom servo isn't measured, a guessed speed would change every chute move
+        print("No --bottom-speed, bottom servo times kept from the current profile")
+        bottom = profile_bottom_times(current)
+        bottom_home_time = current['bottom_home_time']
+        hold_time = current['positions']['front'].get('hold_time')
+    else:
+        bottom = bottom_times(dump_trash, args.bottom_speed, args.bottom_margin, args.bottom_dwell)
+        bottom_home_time = max(bottom.values())
+        hold_time = None
+    profile, expected = make_profile(results, top, bottom, bottom_home_time, args.stuck_margin, hold_time)
+    profile['measurements'] = results
+
+    for position, motion in profile['positions'].items():
+        print(f"{position:<12}{json.dumps(motion)}  about {expected[position]:.2f} s")
+    print(f"stuck time {profile['stuck_time']} s")
+
+    with open(args.output, 'w') as f:
+        json.dump(profile, f, indent = 4)
+    print(f"Profile saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,97 @@
-from picamera2 import Picamera2, Preview
-import libcamera
-import cv2
 import numpy as np
+import threading
 import time
 
+import hardware
+
+Picamera2, Preview, libcamera = hardware.camera()
+
+# Picamera2 format name to the channel order of captured array
+ARRAY_COLOR = {
+    'BGR888' : 'RGB',
+    'RGB888' : 'BGR',
+    'XBGR8888' : 'RGBX',
+    'XRGB8888' : 'BGRX',
+    'YUV420' : 'YUV420',
+    }
+
+# Last n main frames with their capture time and quality score, in preallocated arrays
+# Score is computed on a downscaled Y plane of the lores frame captured with it, when the frames arrive
+class FrameRing:
+    def __init__(self, size, frame_shape, luma_shape, step = 4, motion_weight = 0.5):
+        self.size = size
+        self.frames = np.empty((size, *frame_shape), dtype=np.uint8)
+        self.times = np.full(size, -np.inf)
+        self.sharpness = np.zeros(size)
+        self.motion = np.full(size, np.inf)
+        # Score on every step-th pixel, enough to compare frames of the same scene
+        self.step = step
+        self.luma_shape = luma_shape
+        self.motion_weight = motion_weight
+        
+        # int32, squared luma steps go up to 255 * 255
+        small_shape = (luma_shape[0] // step, luma_shape[1] // step)
+        self.small = np.zeros(small_shape, dtype=np.int32)
+        self.last_small = np.zeros(small_shape, dtype=np.int32)
+        self.n_frames = 0
+        self.lock = threading.Condition()
+    
+    def add(self, frame, lores):
+        # lores : YUV420 frame of the same capture, only its Y plane is read
+        h, w = self.luma_shape
+        with self.lock:
+            i = self.n_frames % self.size
+            np.copyto(self.frames[i], frame)
+            
+            # Sharpness : mean squared gradient, motion : mean absolute change since last frame
+            self.last_small, self.small = self.small, self.last_small
+            self.small[...] = lores[:h:self.step, :w:self.step][:self.small.shape[0], :self.small.shape[1]]
+            dx = np.diff(self.small, axis=1)
+            dy = np.diff(self.small, axis=0)
+            self.sharpness[i] = (np.mean(dx * dx) + np.mean(dy * dy)) / 2
+            self.motion[i] = np.mean(np.abs(self.small - self.last_small)) if self.n_frames else np.inf
+            self.times[i] = time.monotonic()
+            
+            self.n_frames += 1
+            self.lock.notify_all()
+    
+    def scores(self):
+        # Sharp and still frames score high
+        return self.sharpness / (1 + self.motion_weight * self.motion)
+    
+    def best(self, since):
+        # Copy of the best frame captured after since, None if there is none
+        with self.lock:
+            candidates = np.flatnonzero(self.times >= since)
+            if len(candidates) == 0:
+                return None
+            i = candidates[np.argmax(self.scores()[candidates])]
+            return self.frames[i].copy()
+
 class Camera:
-    def __init__(self, capture_size = (1080, 1080), preview_size = (480, 480)):
+    def __init__(self, capture_size = (1080, 1080), preview_size = (480, 480), dual_stream = True):
         self.preview_size = preview_size
+        # Keep one configuration running with main and lores stream, no switch_mode per capture
+        self.dual_stream = dual_stream
+        # Recent main frames scored on lores, see start_frame_buffer
+        self.frame_ring = None
+        # Frames are only copied while set, see set_frame_buffer_active
+        self.frame_buffer_active = threading.Event()
         
         try:
             self.picam = Picamera2()
             
             # Set configuration for camera, main for captured imaged, lores for preview
-            self.capture_config = self.picam.create_still_configuration(main={"size": capture_size})
-            self.preview_config = self.picam.create_preview_configuration(lores={"size": preview_size}, display="lores")
+            if self.dual_stream:
+                self.preview_config = self.picam.create_preview_configuration(main={"size": capture_size}, lores={"size": preview_size}, display="lores")
+                self.capture_config = self.preview_config
+            else:
+                self.capture_config = self.picam.create_still_configuration(main={"size": capture_size})
+                self.preview_config = self.picam.create_preview_configuration(lores={"size": preview_size}, display="lores")
     
             # Trasform image because the camera is flipped on the prototype
-            self.capture_config['transform'] = libcamera.Transform(hflip=1, vflip=1)
             self.preview_config['transform'] = libcamera.Transform(hflip=1, vflip=1)
+            self.capture_config['transform'] = libcamera.Transform(hflip=1, vflip=1)
             
             # Turn on the camera
             self.picam.configure(self.preview_config)
@@ -31,6 +105,10 @@ class Camera:
             print("Camera initialized")
     
     def capture_img(self):
+        # Main stream is already running, take the latest frame
+        if self.dual_stream:
+            return self.picam.capture_image("main")
+        
         # Give time to camera to switch mode
         time.sleep(0.1)
         
@@ -42,9 +120,83 @@ class Camera:
         self.picam.switch_mode(self.preview_config)
         return image
     
+    def capture_array(self, stream = "main"):
+        # Lores stream is running in preview mode, no need to switch
+        if stream == "lores" or self.dual_stream:
+            return self.picam.capture_array(stream)
+        
+        # Give time to camera to switch mode
+        time.sleep(0.1)
+        
+        self.picam.switch_mode(self.capture_config)
+        array = self.picam.capture_array(stream)
+        self.picam.switch_mode(self.preview_config)
+        return array
+    
+    def array_color(self, stream = "main"):
+        # Channel order of capture_array, used by classify.ArrayPreprocessor
+        config = self.preview_config if stream == "lores" else self.capture_config
+        return ARRAY_COLOR[config[stream]['format']]
+    
+    def array_size(self, stream = "main"):
+        # (w, h) of the stream, capture_array may return wider rows (stride padding)
+        config = self.preview_config if stream == "lores" else self.capture_config
+        return tuple(config[stream]['size'])
+    
+    def start_frame_buffer(self, size = 8):
+        # Keep copying main frames into a ring buffer while active, capture_best picks from it
+        # Needs both streams running, without dual_stream capture_array switches mode instead
+        if not self.dual_stream:
+            return
+        w, h = self.preview_config['lores']['size']
+        (frame, _), _ = self.picam.capture_arrays(["main", "lores"])
+        self.frame_ring = FrameRing(size, frame.shape, (h, w))
+        self.frame_thread = threading.Thread(target = self.fill_frame_buffer, name = "frame-buffer", daemon = True)
+        self.frame_thread.start()
+    
+    def fill_frame_buffer(self):
+        while self.frame_ring is not None:
+            # Nothing happening on the platform, don't copy and score frames for nothing
+            if not self.frame_buffer_active.wait(0.5):
+                continue
+            # Main and lores of the same request, the score of one is the score of the other
+            (frame, lores), _ = self.picam.capture_arrays(["main", "lores"])
+            ring = self.frame_ring
+            if ring is not None:
+                ring.add(frame, lores)
+    
+    def set_frame_buffer_active(self, active):
+        # Called by sensor.ObjectWatcher when something moves on the platform or stops moving
+        if active:
+            self.frame_buffer_active.set()
+        else:
+            self.frame_buffer_active.clear()
+    
+    def stop_frame_buffer(self):
+        self.frame_ring = None
+        self.frame_buffer_active.set()
+    
+    def capture_best(self, trigger_time, pre_trigger = 0.3, min_wait = 0.1, max_wait = 1.0, still_motion = 1.0, n_still = 2):
+        # Best main frame around the trigger, instead of sleeping and hoping the item stopped moving
+        # Returns early once n_still frames in a row barely changed, otherwise waits max_wait
+        ring = self.frame_ring
+        with ring.lock:
+            while True:
+                now = time.monotonic()
+                if now >= trigger_time + max_wait:
+                    break
+                if now >= trigger_time + min_wait:
+                    recent = [(ring.n_frames - 1 - k) % ring.size for k in range(min(n_still, ring.n_frames))]
+                    if len(recent) == n_still and all(ring.times[i] >= trigger_time and ring.motion[i] < still_motion for i in recent):
+                        break
+                ring.lock.wait(trigger_time + max_wait - now)
+        return ring.best(trigger_time - pre_trigger)
+    
     def display_text(self, text):
         # Give time to prepare for display
         time.sleep(0.2)
+        # cv2 is slow to import, only the overlay needs it
+        import cv2
         color = (0, 255, 0, 255)
         font = cv2.FONT_HERSHEY_SIMPLEX
         scale = 1
@@ -1,45 +1,274 @@
 from PIL import Image
 import numpy as np
+import contextlib
+import threading
+import queue
 import time
-import tensorflow as tf
 import math
 import os
+from collections import OrderedDict
+
+# tensorflow and cv2 take seconds to import on the Pi, they are only imported when first needed
+Interpreter = None
+
+def load_interpreter():
+    # tflite_runtime only ships the interpreter, much lighter than full tensorflow
+    global Interpreter
+    if Interpreter is None:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+# One .tflite model and its interpreter
+# Tensors are looked up once at load time, not on every frame
+# num_threads : threads of one invoke, None leaves the interpreter default (1)
+# Not thread safe, use InterpreterPool to call it from several threads
+class TFLiteModel:
+    def __init__(self, model_path, batch_size = 1, warm_up = True, num_threads = None):
+        self.model_path = model_path
+        self.name = os.path.basename(model_path)
+        self.num_threads = num_threads
+        self.interpreter = load_interpreter()(model_path, num_threads = num_threads)
+        self.interpreter.allocate_tensors()
+        _, self.height, self.width, _ = self.interpreter.get_input_details()[0]['shape']
+        self.batch_size = 1
+        self.warm_up_time = None
+        self.load_tensor_details()
+        
+        # Resize model input to process n images per invoke
+        if batch_size > 1:
+            self.resize_batch(batch_size)
+        
+        # First invoke is slow (memory planning, kernel setup), pay it at startup instead of on the first item
+        if warm_up:
+            self.warm_up()
+    
+    def get_input_shape(self):
+        return (self.height, self.width)
+    
+    def resize_batch(self, batch_size):
+        # Change the first dimension of input tensor, then allocate again
+        self.interpreter.resize_tensor_input(self.input_index, [batch_size, self.height, self.width, 3])
+        self.interpreter.allocate_tensors()
+        self.batch_size = batch_size
+        self.load_tensor_details()
+    
+    def load_tensor_details(self):
+        # Look up tensors once, they only change after allocate_tensors
+        input_details = self.interpreter.get_input_details()[0]
+        output_details = self.interpreter.get_output_details()[0]
+        self.input_index = input_details['index']
+        self.output_index = output_details['index']
+        self.input_dtype = input_details['dtype']
+        self.output_dtype = output_details['dtype']
+        
+        # Function returning numpy view of the tensor, calling it is cheap
+        self.input_tensor = self.interpreter.tensor(self.input_index)
+        self.output_tensor = self.interpreter.tensor(self.output_index)
+        
+        # Pixel (0 - 255) to model input : pixel * input_mult + input_add
+        # Float model expects pixel / 255
+        # Quantized model expects (pixel / 255) / scale + zero_point
+        self.input_mult, self.input_add = 1 / 255, 0
+        input_scale, input_zero_point = input_details['quantization']
+        if not np.issubdtype(self.input_dtype, np.floating) and input_scale > 0:
+            self.input_mult = 1 / (255 * input_scale)
+            self.input_add = input_zero_point
+        
+        # Quantized output back to probability : (output - zero_point) * scale
+        self.output_scale, self.output_zero_point = output_details['quantization']
+        self.output_quantized = not np.issubdtype(self.output_dtype, np.floating) and self.output_scale > 0
+    
+    def warm_up(self):
+        # Run once on a blank input, keep the time it took for the startup report
+        time1 = time.perf_counter()
+        self.input_tensor()[...] = 0
+        self.interpreter.invoke()
+        self.warm_up_time = time.perf_counter() - time1
+        return self.warm_up_time
+    
+    def write_input(self, input_tensor, images):
+        # Normalize and write images into the input tensor in one vectorized pass
+        images = np.asarray(images, dtype=np.uint8)
+        unit_mult = abs(self.input_mult - 1) < 1e-3
+        
+        if np.issubdtype(self.input_dtype, np.floating):
+            np.multiply(images, np.float32(self.input_mult), out=input_tensor)
+            if self.input_add:
+                input_tensor += np.float32(self.input_add)
+        elif unit_mult and self.input_add == 0 and self.input_dtype == np.uint8:
+            # Common uint8 model with scale 1/255, pixel is already the input
+            input_tensor[...] = images
+        elif unit_mult and self.input_add == -128 and self.input_dtype == np.int8:
+            # Common int8 model with scale 1/255, flipping the top bit is pixel - 128
+            np.bitwise_xor(images, np.uint8(0x80), out=input_tensor.view(np.uint8))
+        else:
+            info = np.iinfo(self.input_dtype)
+            values = np.multiply(images, np.float32(self.input_mult))
+            values += np.float32(self.input_add)
+            np.rint(values, out=values)
+            np.clip(values, info.min, info.max, out=values)
+            input_tensor[...] = values
+    
+    def read_output(self):
+        # Copy the output, the tensor gets overwritten on next invoke
+        output = self.output_tensor()
+        if self.output_quantized:
+            return (output.astype(np.float32) - self.output_zero_point) * np.float32(self.output_scale)
+        return output.copy()
+    
+    def fit_image(self, image):
+        # Models of a cascade may take different sizes, images come at the largest one and are shrunk when needed
+        image = np.asarray(image, dtype=np.uint8)
+        if image.shape[:2] != (self.height, self.width):
+            import cv2
+            image = cv2.resize(image, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        return image
+    
+    def set_input_tensor(self, image):
+        # Put the image on first slot of tensor's input
+        self.write_input(self.input_tensor()[0], self.fit_image(image))
+
+    def predict_image(self, image, top_k=1):
+        self.set_input_tensor(image)
+        # Predicting
+        self.interpreter.invoke()
+        # Get result, image is in the first slot even when the model takes a batch
+        output = self.read_output()[0].reshape(-1)
+        ordered = np.argpartition(-output, 1)
+        # Return label's index + probability
+        return [(i, output[i]) for i in ordered[:top_k]]
+
+    def predict_batch(self, images):
+        # Fill the batch, unused slots stay zero
+        n_images = len(images)
+        if n_images > self.batch_size:
+            raise ValueError(f"Got {n_images} images, batch size is {self.batch_size}")
+        
+        # Temporary views only, invoke fails while a view of the interpreter's buffers is alive
+        self.write_input(self.input_tensor()[:n_images], np.stack([self.fit_image(image) for image in images]))
+        self.input_tensor()[n_images:] = 0
+        
+        self.interpreter.invoke()
+        output = self.read_output()
+        # Return probabilities of the filled slots only
+        return output[:n_images].reshape(n_images, -1)
+
+# n_instances interpreters of the same model, every call takes a free one
+# Safe to call from several threads, up to n_instances run at the same time
+# The model file is memory mapped, instances share its weights and only add their own tensor arena
+class InterpreterPool:
+    def __init__(self, model_path, n_instances = 1, num_threads = None, batch_size = 1, warm_up = True):
+        self.models = [TFLiteModel(model_path, batch_size, warm_up, num_threads) for _ in range(n_instances)]
+        # Last used first, its buffers are still in cache
+        self.free = queue.LifoQueue()
+        for model in self.models:
+            self.free.put(model)
+        
+        self.model_path = model_path
+        self.name = self.models[0].name
+        self.num_threads = num_threads
+        self.interpreter = self.models[0].interpreter
+        self.height, self.width = self.models[0].get_input_shape()
+        self.batch_size = self.models[0].batch_size
+        # Startup cost of the whole stage
+        self.warm_up_time = sum(model.warm_up_time or 0 for model in self.models) if warm_up else None
+    
+    def __len__(self):
+        return len(self.models)
+    
+    @contextlib.contextmanager
+    def acquire(self):
+        # Blocks until an interpreter is free
+        model = self.free.get()
+        try:
+            yield model
+        finally:
+            self.free.put(model)
+    
+    def get_input_shape(self):
+        return (self.height, self.width)
+    
+    def resize_batch(self, batch_size):
+        # Take every interpreter, no call runs while tensors are allocated again
+        models = [self.free.get() for _ in self.models]
+        try:
+            for model in models:
+                model.resize_batch(batch_size)
+        finally:
+            for model in models:
+                self.free.put(model)
+        self.batch_size = batch_size
+    
+    def predict_image(self, image, top_k=1):
+        with self.acquire() as model:
+            return model.predict_image(image, top_k)
+    
+    def predict_batch(self, images):
+        with self.acquire() as model:
+            return model.predict_batch(images)
 
 class ImageClassifier:
-    def __init__(self, path = None, model_name = None, label_name = "labelmap.txt", category_name = "category.txt"):
+    # model_name : file in path, or list of files for a cascade (cheapest first), None takes the first .tflite
+    # thresholds : a stage answers when its top probability reaches its threshold, otherwise the next stage runs
+    # n_interpreters : interpreters per stage, as many images are classified at the same time from several threads
+    # num_threads : threads of every interpreter, n_interpreters * num_threads should not go over the number of cores
+    def __init__(self, path = None, model_name = None, label_name = "labelmap.txt", category_name = "category.txt", batch_size = 1, cache = None, thresholds = 0.8, warm_up = True,
+                 n_interpreters = 1, num_threads = None):
+        # Optional InferenceCache, skip the model for scenes seen recently
+        self.cache = cache
         try:
             # Set path
             label_path = f"{path}/{label_name}"
             category_path = f"{path}/{category_name}"
-            model_path = f"{path}/{model_name}"
             
             if model_name == None:
+                model_names = []
                 for file in os.listdir(path):
                     if file.endswith(".tflite"):
-                        model_path = f"{path}/{file}"
+                        model_names = [file]
                         break
+            elif isinstance(model_name, str):
+                model_names = [model_name]
+            else:
+                model_names = list(model_name)
+            model_paths = [f"{path}/{name}" for name in model_names]
             
             # Check if path exist
-            if not (os.path.exists(model_path)) :
-                raise FileNotFoundError(model_path, "doesn't exist")
+            if not model_paths:
+                raise FileNotFoundError(path, "has no .tflite model")
+            for model_path in model_paths:
+                if not (os.path.exists(model_path)) :
+                    raise FileNotFoundError(model_path, "doesn't exist")
             if not (os.path.exists(label_path)) :
                 raise FileNotFoundError(label_path, "doesn't exist")
             if not (os.path.exists(category_path)) :
                 raise FileNotFoundError(category_path, "doesn't exist")
             
-            # Import Model
-            self.interpreter = tf.lite.Interpreter(model_path)
-            
             # Read class labels
             self.labels = load_labels(label_path)
             
             # Read Category
             self.categories = load_labels(category_path)
             
-            # Try allocating tensors
+            # Every stage but the last one needs a threshold
+            if isinstance(thresholds, (int, float)):
+                thresholds = [thresholds] * (len(model_paths) - 1)
+            if len(thresholds) != len(model_paths) - 1:
+                raise ValueError(f"{len(model_paths)} models need {len(model_paths) - 1} thresholds, got {len(thresholds)}")
+            self.thresholds = list(thresholds)
+            
+            # Import Model
             try:
-                self.interpreter.allocate_tensors()
-                _, self.height, self.width, _ = self.interpreter.get_input_details()[0]['shape']
+                # Every stage has its own pool, a cascade item only holds one interpreter at a time
+                self.stages = [InterpreterPool(model_path, n_interpreters, num_threads, batch_size, warm_up) for model_path in model_paths]
+                self.interpreter = self.stages[0].interpreter
+                # Images are prepared for the largest stage, smaller ones downsample, no stage gets an upsampled image
+                self.height, self.width = max((stage.get_input_shape() for stage in self.stages), key = lambda shape: shape[0] * shape[1])
+                self.batch_size = self.stages[0].batch_size
                 print("Image Shape (", self.width, ",", self.height, ")")
             except:
                 print("Something went wrong")
@@ -51,43 +280,185 @@ class ImageClassifier:
             print("Ready to classify")
     
     def get_input_shape(self):
-        # Get input shape for model
+        # Get input shape for model, the largest input of the cascade
         return (self.height, self.width)
     
-    def set_input_tensor(self, image):
-        # Select first layer of tensor
-        tensor_index = self.interpreter.get_input_details()[0]['index']
-        input_tensor = self.interpreter.tensor(tensor_index)()[0]
-        # Put the image on tensor's input
-        input_tensor[:, :] = image
-        input_tensor /= 255.0
-
-    def predict_image(self, image, top_k=1):
-        self.set_input_tensor(image)
-        # Predicting
-        self.interpreter.invoke()
-        # Get result
-        output_details = self.interpreter.get_output_details()[0]
-        output = np.squeeze(self.interpreter.get_tensor(output_details['index']))
-        ordered = np.argpartition(-output, 1)
-        # Return label's index + probability
-        return [(i, output[i]) for i in ordered[:top_k]]
-
-    def classify_image(self, image):
-        # Classify the image.
-        time1 = time.time()
-        label_id, prob = self.predict_image(image)[0]
-        time2 = time.time()
-        
-        result = {
+    def resize_batch(self, batch_size):
+        for model in self.stages:
+            model.resize_batch(batch_size)
+        self.batch_size = batch_size
+    
+    def predict_image(self, image, top_k=1, stage=0):
+        return self.stages[stage].predict_image(image, top_k)
+    
+    def predict_batch(self, images, stage=0):
+        return self.stages[stage].predict_batch(images)
+    
+    def is_final(self, stage, prob):
+        # Last stage always answers
+        return stage == len(self.stages) - 1 or prob >= self.thresholds[stage]
+    
+    def make_result(self, label_id, prob, stage, stage_times):
+        return {
             'category' : self.categories[label_id],
             'sub_category' : self.labels[label_id],
             'probability' : prob,
-            'time' : np.round(time2-time1, 3)
+            'time' : np.round(sum(stage_times), 3),
+            # Which model answered and how long each stage took
+            'stage' : stage,
+            'model' : self.stages[stage].name,
+            'stage_times' : stage_times,
             }
+
+    def classify_batch(self, images):
+        # Classify up to batch_size images in one invoke per stage
+        results = [None] * len(images)
+        hashes = [None] * len(images)
+        
+        # Cached images don't go to the model
+        if self.cache is not None:
+            for i, image in enumerate(images):
+                time1 = time.perf_counter()
+                hashes[i] = image_hash(image)
+                cached = self.cache.get(hashes[i])
+                if cached is not None:
+                    results[i] = dict(cached, time = np.round(time.perf_counter()-time1, 3), cached = True)
+        
+        # Unsure images go on to the next stage
+        pending = [i for i, result in enumerate(results) if result is None]
+        stage_times = {i : [] for i in pending}
+        for stage, model in enumerate(self.stages):
+            if not pending:
+                break
+            time1 = time.perf_counter()
+            output = model.predict_batch([images[i] for i in pending])
+            time2 = time.perf_counter()
+            
+            # Share the invoke time equally between images
+            item_time = np.round((time2-time1) / len(pending), 3)
+            unsure = []
+            for i, probs in zip(pending, output):
+                stage_times[i].append(item_time)
+                label_id = int(np.argmax(probs))
+                if not self.is_final(stage, probs[label_id]):
+                    unsure.append(i)
+                    continue
+                results[i] = self.make_result(label_id, probs[label_id], stage, stage_times[i])
+                if self.cache is not None:
+                    self.cache.put(hashes[i], results[i])
+            pending = unsure
+        
+        return results
+
+    def classify_image(self, image):
+        # Same scene as a recent one, reuse its result
+        if self.cache is not None:
+            time1 = time.perf_counter()
+            img_hash = image_hash(image)
+            cached = self.cache.get(img_hash)
+            if cached is not None:
+                return dict(cached, time = np.round(time.perf_counter()-time1, 3), cached = True)
+        
+        # Classify the image, cheapest model first
+        stage_times = []
+        for stage, model in enumerate(self.stages):
+            time1 = time.perf_counter()
+            label_id, prob = model.predict_image(image)[0]
+            time2 = time.perf_counter()
+            stage_times.append(np.round(time2-time1, 3))
+            if self.is_final(stage, prob):
+                break
+        
+        result = self.make_result(label_id, prob, stage, stage_times)
+        
+        if self.cache is not None:
+            self.cache.put(img_hash, result)
         
         return result
 
+# LRU cache of classification results keyed by perceptual hash (see image_hash)
+# A lookup also matches hashes within max_distance differing bits, so tiny changes still hit
+# Fuzzy matching is for offline tools only, on the bin different items on the same platform can be a few bits apart
+# Safe to share between threads
+class InferenceCache:
+    def __init__(self, capacity = 256, max_distance = 0):
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # Hashes as uint64 array for vectorized distance, rebuilt when keys change
+        self.key_array = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def get(self, img_hash):
+        with self.lock:
+            key = img_hash
+            if key not in self.entries and self.max_distance > 0 and self.entries:
+                key = self.closest(img_hash)
+            
+            if key is None or key not in self.entries:
+                self.misses += 1
+                return None
+            
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+    
+    def closest(self, img_hash):
+        # Nearest cached hash within max_distance bits, None if there is none
+        if self.key_array is None:
+            self.key_array = np.array(list(self.entries), dtype=np.uint64)
+        different = self.key_array ^ np.uint64(img_hash)
+        distance = BIT_COUNT[different.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+        i = int(np.argmin(distance))
+        if distance[i] > self.max_distance:
+            return None
+        return int(self.key_array[i])
+    
+    def put(self, img_hash, result):
+        with self.lock:
+            if img_hash not in self.entries:
+                self.key_array = None
+            self.entries[img_hash] = result
+            self.entries.move_to_end(img_hash)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.key_array = None
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size' : len(self.entries),
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+            'hit_rate' : self.hits / total if total else 0.0,
+            }
+
+# Number of set bits of every byte value
+BIT_COUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
+# 64 bit difference hash of an image (PIL or RGB array)
+# Grayscale 9x8 thumbnail, one bit per pixel brighter than its right neighbour
+def image_hash(image):
+    import cv2
+    pixels = np.asarray(image, dtype=np.uint8)
+    if pixels.ndim == 3:
+        pixels = cv2.cvtColor(np.ascontiguousarray(pixels[:, :, :3]), cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(pixels, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
 # Read the labels from the text file as a Python list
 def load_labels(path):
     with open(path, 'r') as f:
@@ -115,9 +486,122 @@ def preprocess_img(image, size):
         else:
             h_img += 1
     image = image.crop((x, y, w_img - x, h_img - y))
-    image.thumbnail(size, Image.ANTIALIAS)
+    image.thumbnail(size, Image.LANCZOS)
     return image
 
+# Array version of preprocess_img for raw camera frames
+# Crop, resize and color conversion go straight into a preallocated buffer
+# color : 'RGB', 'BGR', 'RGBX', 'BGRX' (h, w, c) or 'YUV420' (h * 3/2, w) planar
+# frame_size : (w, h) of the stream, arrays may be wider (row stride padding), extra columns are left out
+class ArrayPreprocessor:
+    def __init__(self, size, color = 'RGB', frame_size = None):
+        if color not in ('RGB', 'BGR', 'RGBX', 'BGRX', 'YUV420'):
+            raise ValueError(f"Color '{color}' is not valid")
+        if color == 'YUV420' and frame_size is not None:
+            check_yuv420_size(*frame_size)
+        self.size = size
+        self.color = color
+        self.frame_size = frame_size
+        w_target, h_target = size
+        
+        # cv2 import is paid here, at startup, not on the first frame (process and image_hash import it again for free)
+        import cv2
+        
+        # Output buffer, reused on every call
+        self.out = np.empty((h_target, w_target, 3), dtype=np.uint8)
+        
+        # Scratch buffers for channels that need conversion after resizing
+        self.resized = None
+        if color in ('BGR', 'RGBX', 'BGRX'):
+            self.resized = np.empty((h_target, w_target, len(color)), dtype=np.uint8)
+        elif color == 'YUV420':
+            if w_target % 2 or h_target % 2:
+                raise ValueError(f"YUV420 needs even size, got {size}")
+            # Small I420 frame, converted to RGB in one call
+            self.resized = np.empty((h_target * 3 // 2, w_target), dtype=np.uint8)
+    
+    def crop_box(self, w_img, h_img):
+        # Biggest box in the middle with the same ratio as target
+        w_target, h_target = self.size
+        ratio = w_target / h_target
+        if w_img > ratio * h_img:
+            w_crop, h_crop = int(round(ratio * h_img)), h_img
+        else:
+            w_crop, h_crop = w_img, int(round(w_img / ratio))
+        x, y = (w_img - w_crop) // 2, (h_img - h_crop) // 2
+        return x, y, w_crop, h_crop
+    
+    def process(self, frame):
+        import cv2
+        if self.color == 'YUV420':
+            return self.process_yuv420(frame)
+        
+        h_img, w_img = frame.shape[:2]
+        if self.frame_size is not None:
+            w_img = min(w_img, self.frame_size[0])
+        x, y, w_crop, h_crop = self.crop_box(w_img, h_img)
+        crop = frame[y:y + h_crop, x:x + w_crop]
+        
+        # INTER_AREA averages pixels when shrinking, like thumbnail antialias
+        if self.color == 'RGB':
+            cv2.resize(crop, self.size, dst=self.out, interpolation=cv2.INTER_AREA)
+            return self.out
+        
+        cv2.resize(crop, self.size, dst=self.resized, interpolation=cv2.INTER_AREA)
+        if self.color == 'BGR':
+            cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst=self.out)
+        elif self.color == 'RGBX':
+            cv2.cvtColor(self.resized, cv2.COLOR_RGBA2RGB, dst=self.out)
+        else:
+            cv2.cvtColor(self.resized, cv2.COLOR_BGRA2RGB, dst=self.out)
+        return self.out
+    
+    def process_yuv420(self, frame):
+        import cv2
+        # I420 layout : Y plane (h, stride) then U and V planes (h/2, stride/2) each
+        rows, stride = frame.shape
+        if rows % 3:
+            raise ValueError(f"YUV420 frame should have height * 3/2 rows, got {rows}")
+        h_img = rows * 2 // 3
+        # Columns past the stream width are stride padding
+        w_img = stride if self.frame_size is None else self.frame_size[0]
+        if w_img > stride:
+            raise ValueError(f"YUV420 frame is {stride} wide, smaller than the stream width {w_img}")
+        check_yuv420_size(w_img, h_img)
+        x, y, w_crop, h_crop = self.crop_box(w_img, h_img)
+        x, y = x // 2 * 2, y // 2 * 2
+        
+        # Crop and resize every plane on its own, then convert only the small frame
+        w_target, h_target = self.size
+        size_uv = (w_target // 2, h_target // 2)
+        out_planes = self.planes(self.resized, w_target, h_target)
+        in_planes = self.planes(frame, stride, h_img)
+        boxes = ((x, y, w_crop, h_crop), (x // 2, y // 2, w_crop // 2, h_crop // 2), (x // 2, y // 2, w_crop // 2, h_crop // 2))
+        for plane, out_plane, (x0, y0, w0, h0), size in zip(in_planes, out_planes, boxes, (self.size, size_uv, size_uv)):
+            cv2.resize(plane[y0:y0 + h0, x0:x0 + w0], size, dst=out_plane, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self.resized, cv2.COLOR_YUV2RGB_I420, dst=self.out)
+        return self.out
+    
+    @staticmethod
+    def planes(frame, w, h):
+        # Views of Y, U and V planes inside an I420 frame
+        y_size = h
+        uv_rows = h // 4
+        return (
+            frame[:y_size],
+            frame[y_size:y_size + uv_rows].reshape(h // 2, w // 2),
+            frame[y_size + uv_rows:y_size + 2 * uv_rows].reshape(h // 2, w // 2),
+            )
+
+# U and V rows are packed two per frame row, planes only split cleanly with even width and height a multiple of 4
+def check_yuv420_size(w, h):
+    if w % 2 or h % 4:
+        raise ValueError(f"YUV420 frame needs an even width and a height multiple of 4, got {w}x{h}")
+
+# One shot version, prefer ArrayPreprocessor when processing many frames
+def preprocess_array(frame, size, color = 'RGB'):
+    return ArrayPreprocessor(size, color).process(frame).copy()
+
 # Just for testing
 def main():
     image_classifier = ImageClassifier("model")
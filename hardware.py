@@ -0,0 +1,39 @@
+import os
+
+# Hardware backend used by sensor, servo, camera and oled modules
+# 'device' : real Raspberry Pi libraries
+# 'sim' : simulated hardware from sim.py, runs on any Linux box
+BACKEND = os.environ.get("TRASH_BACKEND", "device")
+
+def use_backend(name):
+    # Must be called before importing sensor, servo, camera or oled
+    global BACKEND
+    if name not in ('device', 'sim'):
+        raise ValueError(f"Backend '{name}' is not valid")
+    BACKEND = name
+
+def gpio():
+    if BACKEND == 'sim':
+        import sim
+        return sim.GPIO
+    import RPi.GPIO as GPIO
+    return GPIO
+
+# Returns Picamera2, Preview, libcamera
+def camera():
+    if BACKEND == 'sim':
+        import sim
+        return sim.Picamera2, sim.Preview, sim.libcamera
+    from picamera2 import Picamera2, Preview
+    import libcamera
+    return Picamera2, Preview, libcamera
+
+# Returns board, digitalio, adafruit_ssd1306
+def oled():
+    if BACKEND == 'sim':
+        import sim
+        return sim.board, sim.digitalio, sim.adafruit_ssd1306
+    import board
+    import digitalio
+    import adafruit_ssd1306
+    return board, digitalio, adafruit_ssd1306
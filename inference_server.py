@@ -0,0 +1,365 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future
+import numpy as np
+import http.client
+import urllib.parse
+import threading
+import argparse
+import queue
+import json
+import time
+import os
+
+import classify
+
+# Several bins share one classifier on a bigger box
+# POST /classify : body is the preprocessed image (uint8, h x w x 3), shape in X-Shape header "h,w,3"
+# Answer is the result dict of ImageClassifier.classify_image as json
+# GET /stats : batching stats as json
+
+# Requests from all clients go to one queue, a single thread takes them out in batches
+# A batch runs once it has max_batch images, or max_delay after its first image came in
+class DynamicBatcher:
+    def __init__(self, img_classifier, max_batch = 8, max_delay = 0.01):
+        self.img_classifier = img_classifier
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+
+        self.n_images = 0
+        self.n_batches = 0
+        self.batch_sizes = {}
+        self.queue_time = 0.0
+        self.stats_lock = threading.Lock()
+        self.closed = False
+
+        self.thread = threading.Thread(target = self.run, name = "batcher", daemon = True)
+        self.thread.start()
+
+    def submit(self, image):
+        # Future of the result, set by the batcher thread
+        future = Future()
+        if self.closed:
+            future.set_exception(ConnectionError("Inference server is closing"))
+            return future
+        self.queue.put((image, future, time.perf_counter()))
+        return future
+
+    def classify(self, image, timeout = None):
+        return self.submit(image).result(timeout)
+
+    def collect(self):
+        # Block for the first request, then take what comes in until the batch is full or the delay is over
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout = timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # Stop after this batch
+                self.queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            try:
+                results = self.img_classifier.classify_batch([image for image, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+            with self.stats_lock:
+                self.n_images += len(batch)
+                self.n_batches += 1
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+                self.queue_time += sum(start - queued for _, _, queued in batch)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'images' : self.n_images,
+                'batches' : self.n_batches,
+                'mean_batch' : self.n_images / self.n_batches if self.n_batches else 0.0,
+                'mean_queue_ms' : self.queue_time / self.n_images * 1000 if self.n_images else 0.0,
+                'batch_sizes' : {str(size) : n for size, n in sorted(self.batch_sizes.items())},
+                }
+
+    def close(self):
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        # Requests that came in while closing get an error instead of waiting forever
+        while not self.queue.empty():
+            request = self.queue.get()
+            if request is not None:
+                request[1].set_exception(ConnectionError("Inference server is closing"))
+
+# Image of a request, only (h, w, 3) uint8 : anything else would fail the whole batch it lands in
+def parse_image(shape_header, body):
+    shape = tuple(int(value) for value in shape_header.split(","))
+    if len(shape) != 3 or shape[2] != 3 or shape[0] <= 0 or shape[1] <= 0:
+        raise ValueError(f"Image should be h,w,3 uint8, got shape {shape}")
+    if len(body) != shape[0] * shape[1] * 3:
+        raise ValueError(f"Image {shape} needs {shape[0] * shape[1] * 3} bytes, got {len(body)}")
+    return np.frombuffer(body, dtype=np.uint8).reshape(shape)
+
+# Result dict with plain python types, numpy floats don't go through json
+def to_json(result):
+    return {
+        key : [float(value) for value in values] if key == 'stage_times' else
+              float(values) if isinstance(values, (np.floating, float)) else
+              int(values) if isinstance(values, np.integer) else values
+        for key, values in result.items()
+        }
+
+# HTTP front of the batcher, one thread per connection, connections are kept alive
+class InferenceServer:
+    def __init__(self, img_classifier, port = 9102, host = "0.0.0.0", max_batch = 8, max_delay = 0.01):
+        self.batcher = DynamicBatcher(img_classifier, max_batch, max_delay)
+        batcher = self.batcher
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in two writes, without this the client waits for a delayed ACK (~40 ms)
+            disable_nagle_algorithm = True
+
+            def send_json(handler, code, value):
+                body = json.dumps(value).encode()
+                handler.send_response(code)
+                handler.send_header("Content-Type", "application/json")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def do_GET(handler):
+                if handler.path != "/stats":
+                    handler.send_error(404)
+                    return
+                handler.send_json(200, batcher.stats())
+
+            def do_POST(handler):
+                if handler.path != "/classify":
+                    handler.send_error(404)
+                    return
+                try:
+                    body = handler.rfile.read(int(handler.headers["Content-Length"]))
+                    image = parse_image(handler.headers["X-Shape"], body)
+                except (AttributeError, TypeError, ValueError) as e:
+                    handler.send_json(400, {'error' : str(e)})
+                    return
+                try:
+                    result = batcher.classify(image)
+                except Exception as e:
+                    handler.send_json(500, {'error' : str(e)})
+                    return
+                handler.send_json(200, to_json(result))
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target = self.server.serve_forever, name = "inference-server", daemon = True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.batcher.close()
+
+# Client for main : same classify_image as ImageClassifier, answered by the server
+# When the server can't be reached, the local classifier answers and the server is tried again after retry_interval
+class RemoteClassifier:
+    def __init__(self, url, fallback, timeout = 0.5, retry_interval = 30.0):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 9102
+        self.fallback = fallback
+        # Recent scenes are still answered by the local cache
+        self.cache = getattr(fallback, 'cache', None)
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+
+        self.conn = None
+        self.lock = threading.Lock()
+        self.retry_time = 0.0
+        self.n_remote = 0
+        self.n_local = 0
+
+    def get_input_shape(self):
+        # Server resizes when its model takes another size
+        return self.fallback.get_input_shape()
+
+    @property
+    def stages(self):
+        return self.fallback.stages
+
+    def request(self, image):
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        headers = {"Content-Type" : "application/octet-stream", "X-Shape" : ",".join(str(n) for n in image.shape)}
+        with self.lock:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout = self.timeout)
+            try:
+                self.conn.request("POST", "/classify", body = image.tobytes(), headers = headers)
+                response = self.conn.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                self.conn.close()
+                self.conn = None
+                raise
+        if response.status != 200:
+            raise ConnectionError(f"Inference server answered {response.status} : {body[:200]}")
+        return json.loads(body)
+
+    def classify_image(self, image):
+        if self.cache is not None:
+            time1 = time.perf_counter()
+            img_hash = classify.image_hash(image)
+            cached = self.cache.get(img_hash)
+            if cached is not None:
+                return dict(cached, time = np.round(time.perf_counter()-time1, 3), cached = True)
+
+        if time.monotonic() >= self.retry_time:
+            time1 = time.perf_counter()
+            try:
+                result = self.request(image)
+            except (OSError, ConnectionError, http.client.HTTPException, ValueError) as e:
+                print("Something went wrong with inference server, classifying on device :", e)
+                self.retry_time = time.monotonic() + self.retry_interval
+            else:
+                # Round trip time, what the item waited
+                result['time'] = np.round(time.perf_counter()-time1, 3)
+                result['remote'] = True
+                self.n_remote += 1
+                if self.cache is not None:
+                    self.cache.put(img_hash, result)
+                return result
+
+        # Local classifier fills its own cache
+        self.n_local += 1
+        return self.fallback.classify_image(image)
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+# Loopback stand-in for a model : same batch API as ImageClassifier, invoke costs a fixed time + a bit per image
+class StandInClassifier:
+    def __init__(self, size = (224, 224), invoke_time = 0.02, image_time = 0.002):
+        self.size = size
+        self.invoke_time = invoke_time
+        self.image_time = image_time
+        self.cache = None
+        self.stages = []
+
+    def get_input_shape(self):
+        return self.size
+
+    def classify_batch(self, images):
+        time.sleep(self.invoke_time + self.image_time * len(images))
+        return [{
+            'category' : "Residu",
+            'sub_category' : "Plastic",
+            'probability' : np.float32(np.asarray(image).mean() / 255),
+            'time' : np.round(self.invoke_time + self.image_time, 3),
+            'stage' : 0,
+            'model' : "stand-in",
+            'stage_times' : [np.round(self.invoke_time + self.image_time, 3)],
+            } for image in images]
+
+    def classify_image(self, image):
+        return self.classify_batch([image])[0]
+
+# Just for testing : concurrent clients against a loopback server, then fallback once it's gone
+def loopback_test(img_classifier, n_clients, n_requests, max_batch, max_delay):
+    server = InferenceServer(img_classifier, port = 0, host = "127.0.0.1", max_batch = max_batch, max_delay = max_delay)
+    size = img_classifier.get_input_shape()
+    clients = [RemoteClassifier(f"http://127.0.0.1:{server.port}", img_classifier, timeout = 5.0) for _ in range(n_clients)]
+    times = []
+
+    def run_client(client, seed):
+        rng = np.random.default_rng(seed)
+        for _ in range(n_requests):
+            image = rng.integers(0, 256, (size[0], size[1], 3), dtype=np.uint8)
+            time1 = time.perf_counter()
+            client.classify_image(image)
+            times.append(time.perf_counter() - time1)
+
+    time1 = time.perf_counter()
+    threads = [threading.Thread(target = run_client, args = (client, i)) for i, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = time.perf_counter() - time1
+
+    print(f"{n_clients} clients x {n_requests} requests in {np.round(total, 3)} s, {n_clients * n_requests / total:.1f} images/s")
+    print(f"Latency p50 {np.percentile(times, 50) * 1000:.1f} ms, p95 {np.percentile(times, 95) * 1000:.1f} ms")
+    print("Server :", server.batcher.stats())
+    print("Remote answers :", sum(client.n_remote for client in clients), "local :", sum(client.n_local for client in clients))
+
+    # Server gone, the next request is answered on device
+    server.close()
+    result = clients[0].classify_image(np.zeros((size[0], size[1], 3), dtype=np.uint8))
+    print("After server stopped :", result['model'], "remote" if result.get('remote') else "on device")
+    for client in clients:
+        client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Serve one classifier to several bins, with dynamic batching")
+    parser.add_argument("--model-path", default = "model")
+    parser.add_argument("--port", type = int, default = 9102)
+    parser.add_argument("--host", default = "0.0.0.0")
+    parser.add_argument("--max-batch", type = int, default = 8)
+    parser.add_argument("--max-delay", type = float, default = 0.01, help = "Longest wait for a batch to fill, seconds")
+    parser.add_argument("--test", action = "store_true", help = "Loopback test with concurrent clients")
+    parser.add_argument("--stand-in", action = "store_true", help = "Fake model, for testing without weights")
+    parser.add_argument("--threads", type = int, default = None, help = "Threads of the interpreter, default : number of CPUs")
+    parser.add_argument("--clients", type = int, default = 4)
+    parser.add_argument("--requests", type = int, default = 25)
+    args = parser.parse_args()
+
+    if args.stand_in:
+        img_classifier = StandInClassifier()
+    else:
+        # Batches run one after the other, one interpreter with every core
+        img_classifier = classify.ImageClassifier(path = args.model_path, batch_size = args.max_batch, num_threads = args.threads or os.cpu_count())
+
+    if args.test:
+        loopback_test(img_classifier, args.clients, args.requests, args.max_batch, args.max_delay)
+        return
+
+    server = InferenceServer(img_classifier, args.port, args.host, args.max_batch, args.max_delay)
+    print(f"Serving on {args.host}:{server.port}, batches of up to {args.max_batch} within {args.max_delay * 1000:.0f} ms")
+    try:
+        while True:
+            time.sleep(60)
+            print(server.batcher.stats())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == "__main__":
+    main()
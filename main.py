@@ -1,30 +1,62 @@
 from PIL import Image
 import numpy as np
-import pandas as pd
+import asyncio
 import time
 import os
 import glob
+import json
+import importlib
 
-import sensor
-import oled
-import camera
-import servo
-import classify
+# Time taken by every startup step, shown once everything is loaded
+startup_times = {}
+
+def timed_import(name):
+    time1 = time.perf_counter()
+    module = importlib.import_module(name)
+    startup_times[f"import {name}"] = time.perf_counter() - time1
+    return module
+
+def timed_startup(name, fn, *args, **kwargs):
+    time1 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    startup_times[name] = time.perf_counter() - time1
+    return result
+
+# Hardware libraries are imported by these modules, tensorflow and cv2 only on first use
+sensor = timed_import("sensor")
+oled = timed_import("oled")
+camera = timed_import("camera")
+servo = timed_import("servo")
+classify = timed_import("classify")
+prediction_log = timed_import("prediction_log")
+storage = timed_import("storage")
+inference_server = timed_import("inference_server")
+metrics = timed_import("metrics")
+
+# Print startup times, and append them to a log to catch slow boots after an update
+def report_startup_times(log_path = None):
+    for name, seconds in startup_times.items():
+        print(f"{name:<28}{seconds * 1000:>10.1f} ms")
+    print(f"{'total':<28}{sum(startup_times.values()) * 1000:>10.1f} ms")
+    if log_path:
+        with open(log_path, 'a') as f:
+            f.write(json.dumps({'time' : time.time(), 'startup_ms' : {name : round(seconds * 1000, 1) for name, seconds in startup_times.items()}}) + "\n")
+
+# Dump position of every category
+DUMP_POSITION = {
+    "Daur Ulang" : 'front',
+    "Guna Ulang" : 'front_right',
+    "B3" : 'back_right',
+    "Organik" : 'back_left',
+    "Residu" : 'front_left',
+    }
 
 # Function for dumping trash according to predicted category
-def dump_trash_category(dump_trash, category):
-    if category == "Daur Ulang":
-        dump_trash.dump_trash_front()
-    elif category == "Guna Ulang":
-        dump_trash.dump_trash_front_right()
-    elif category == "B3":
-        dump_trash.dump_trash_back_right()
-    elif category == "Organik":
-        dump_trash.dump_trash_back_left()
-    elif category == "Residu":
-        dump_trash.dump_trash_front_left()
-    else:
+# dump_trash : DumpTrash, or DumpScheduler to skip moves the next item doesn't need
+async def dump_trash_category(dump_trash, category):
+    if category not in DUMP_POSITION:
         raise ValueError(f"Cateogry {category} is not valid")
+    await dump_trash.dump(DUMP_POSITION[category])
 
 # Display result on the tiny oled screen
 def oled_update_result(oled_screen, result):
@@ -33,55 +65,249 @@ def oled_update_result(oled_screen, result):
     pred_prob = result['probability']
     pred_time = result['time']
     
+    # Prediction time is in second
     oled_screen.display_text(
         f"{pred_category} prob : {pred_prob}",
-        f"{pred_sub_category} {pred_time} ms"
+        f"{pred_sub_category} {pred_time * 1000:.0f} ms"
         )
 
 # Save image and it's prediction result
-def save_prediction_result(image, result, df, img_path, csv_path):
+# store : optional storage.ImageStore, shards the image and keeps the disk budget
+def save_prediction_result(image, result, log, img_path, store = None):
+    # Next file name comes from log's sequence counter
+    img_name = log.next_name()
+    if store is not None:
+        log.append(img_name, result, store.save(image, img_name))
+        store.enforce_budget(log)
+        return
+    
     if not os.path.exists(img_path) :
         os.makedirs(img_path)
+    image.save(f"{img_path}/{img_name}")
     
-    # File increment
-    i = 0
-    while os.path.exists(f"{img_path}/image-{i}.jpeg"):
-        i += 1
+    log.append(img_name, result)
+
+# Detect > capture + classify > display + save + dump > re-baseline
+# Each stage is a task, items move between them through queues
+class Pipeline:
+    def __init__(self, dump_trash, dist_sensor, watcher, picam, oled_screen, img_classifier, preprocessor, writer,
+                 wait_timeout = 1.0, settle_timeout = 1.0, settle_margin = 1.0, result_hold = 3.0,
+                 tracer = None, metrics_path = None, retrigger_cache = None, retrigger_window = 3.0):
+        self.dump_trash = dump_trash
+        self.dist_sensor = dist_sensor
+        self.watcher = watcher
+        self.picam = picam
+        self.oled_screen = oled_screen
+        self.img_classifier = img_classifier
+        self.preprocessor = preprocessor
+        self.writer = writer
+        
+        # Wake up this often while waiting for an object, so the task can be cancelled
+        self.wait_timeout = wait_timeout
+        # Longest time to wait for the item to stop moving before capture
+        self.settle_timeout = settle_timeout
+        self.settle_margin = settle_margin
+        # Prediction stays on screen this long before the idle screen comes back
+        self.result_hold = result_hold
+        self.last_result_time = None
+        
+        # Optional InferenceCache, exact hash only : the platform background makes different items look alike
+        # A result is reused only when the last item is seen again (not dropped, detected within retrigger_window)
+        self.retrigger_cache = retrigger_cache
+        self.retrigger_window = retrigger_window
+        self.last_dump_time = None
+        self.last_dropped = True
+        
+        self.n_items = 0
+        self.n_detected = 0
+        self.start_time = None
+        self.max_items = None
+        self.done = None
+        
+        # Span of every stage of every item, metrics are written to metrics_path after every item
+        self.tracer = tracer or metrics.Tracer()
+        self.metrics_path = metrics_path
     
-    img_name = f"image-{i}.jpeg"
-    image.save(f"{img_path}/{img_name}")
-    columns = ['name', 'pred_category', 'pred_subcategory','probability', 'classifying_time_ms']
+    def timed(self, stage, item, fn, *args):
+        # Positional item, so it can go through run_in_executor
+        return self.tracer.timed(stage, fn, *args, item = item)
     
-    pred_category = result['category']
-    pred_sub_category = result['sub_category']
-    pred_prob = result['probability']
-    pred_time = result['time']    
+    def wait_for_object(self):
+        if not self.watcher.wait(self.wait_timeout):
+            return False
+        # Sensors are used by this pipeline until the next item, stop reporting detections
+        self.watcher.pause()
+        return True
     
-    df.loc[i, columns] = [img_name, pred_category, pred_sub_category, pred_prob, pred_time]
+    def wait_until_still(self):
+        # Item is still once two distance readings agree, instead of a blind sleep
+        deadline = time.monotonic() + self.settle_timeout
+        last_dist = self.dist_sensor.check_distance()
+        while time.monotonic() < deadline:
+            dist = self.dist_sensor.check_distance()
+            if abs(dist - last_dist) < self.settle_margin:
+                return True
+            last_dist = dist
+        return False
     
-    df.to_csv(csv_path, index = False)
-
-# Load previous dataframe if exist
-def load_dataframe(path = None):
-    columns = ['name', 'pred_category', 'pred_subcategory','probability', 'classifying_time_ms']
+    def capture_and_classify(self, item, detect_time):
+        frame = None
+        if self.picam.frame_ring is not None:
+            # Main frame whose lores is the sharpest and stillest, no waiting for the sensor
+            frame = self.timed('capture', item, self.picam.capture_best, detect_time)
+            if frame is None:
+                # No frame in the window (capture stall, buffer inactive), take one now
+                self.tracer.count('capture_fallbacks')
+        if frame is None:
+            self.timed('settle', item, self.wait_until_still)
+            frame = self.timed('capture', item, self.picam.capture_array)
+        
+        # Buffer is reused on next item, copy it for saving
+        img_array = self.timed('preprocess', item, self.preprocessor.process, frame)
+        img = Image.fromarray(img_array.copy())
+        
+        result = self.timed('inference', item, self.classify_item, img_array, detect_time)
+        return img, result
     
-    df = pd.DataFrame(columns = columns)
+    def is_retrigger(self, detect_time):
+        # Last item stayed on the platform and triggered the sensors again
+        return (self.last_dump_time is not None and not self.last_dropped
+                and detect_time - self.last_dump_time < self.retrigger_window)
     
-    if path and os.path.exists(path):
-        df = pd.read_csv(path)
+    def classify_item(self, img_array, detect_time):
+        if self.retrigger_cache is None:
+            return self.img_classifier.classify_image(img_array)
+        
+        time1 = time.perf_counter()
+        img_hash = classify.image_hash(img_array)
+        if self.is_retrigger(detect_time):
+            cached = self.retrigger_cache.get(img_hash)
+            if cached is not None:
+                return dict(cached, time = np.round(time.perf_counter()-time1, 3), cached = True)
+        
+        # New item, only keep its result
+        self.retrigger_cache.clear()
+        result = self.img_classifier.classify_image(img_array)
+        self.retrigger_cache.put(img_hash, result)
+        return result
+    
+    def items_per_minute(self):
+        if not self.n_items:
+            return 0.0
+        return self.n_items / (time.monotonic() - self.start_time) * 60
+    
+    async def detect_stage(self, ready, detected):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Only look for a new item once the platform is back and empty
+            await ready.wait()
+            if await loop.run_in_executor(None, self.wait_for_object):
+                print("Object Detected!")
+                ready.clear()
+                item = self.n_detected
+                self.n_detected += 1
+                # Detect span : from the sensor event to the pipeline picking it up
+                now_ns = time.perf_counter_ns()
+                self.tracer.record('detect', self.watcher.detect_time_ns or now_ns, now_ns, item)
+                await detected.put((item, time.monotonic(), now_ns))
+            elif self.last_result_time is None or time.monotonic() - self.last_result_time > self.result_hold:
+                # Nothing on the platform, refresh the hardware info on every wait timeout
+                await loop.run_in_executor(None, self.timed, 'idle screen', None, self.oled_screen.display_hardware_info)
     
-    return df
+    async def classify_stage(self, detected, classified):
+        loop = asyncio.get_running_loop()
+        while True:
+            item, detect_time, detect_time_ns = await detected.get()
+            img, result = await loop.run_in_executor(None, self.capture_and_classify, item, detect_time)
+            await classified.put((item, detect_time, detect_time_ns, img, result))
+    
+    async def dump_stage(self, classified, ready):
+        loop = asyncio.get_running_loop()
+        while True:
+            item, detect_time, detect_time_ns, img, result = await classified.get()
+            self.last_result_time = time.monotonic()
+            
+            # Display and saving happen while the servos move, servos run on the event loop itself
+            # Save only queues the item, writing it shows up as 'persist'
+            await asyncio.gather(
+                loop.run_in_executor(None, self.timed, 'display', item, oled_update_result, self.oled_screen, result),
+                loop.run_in_executor(None, self.timed, 'save', item, self.writer.put, img, result),
+                self.tracer.timed_async('dump', dump_trash_category(self.dump_trash, result['category']), item = item),
+                )
+            
+            # Platform is home and empty, take a new default distance before the next item
+            await loop.run_in_executor(None, self.timed, 'rebaseline', item, self.dist_sensor.update_default)
+            if self.retrigger_cache is not None:
+                # Still something on the platform, the item didn't fall
+                self.last_dropped = not await loop.run_in_executor(None, self.timed, 'drop check', item, self.dist_sensor.check_object)
+                self.last_dump_time = time.monotonic()
+            self.watcher.resume()
+            ready.set()
+            
+            self.n_items += 1
+            end_ns = time.perf_counter_ns()
+            self.tracer.record('cycle', detect_time_ns, end_ns, item)
+            self.tracer.count('items')
+            self.tracer.count(f"items_{DUMP_POSITION.get(result['category'], 'unknown')}")
+            self.tracer.set_gauge('items_per_minute', round(self.items_per_minute(), 3))
+            if self.metrics_path:
+                await loop.run_in_executor(None, self.tracer.write_textfile, self.metrics_path)
+            print(f"Item {self.n_items} done in {np.round((end_ns - detect_time_ns) / 1e9, 3)} s, {np.round(self.items_per_minute(), 2)} items/min")
+            
+            if self.max_items and self.n_items >= self.max_items:
+                self.done.set()
+    
+    async def run(self, max_items = None):
+        # Run forever, or until max_items are dumped
+        self.start_time = time.monotonic()
+        self.max_items = max_items
+        self.done = asyncio.Event()
+        ready = asyncio.Event()
+        ready.set()
+        detected = asyncio.Queue(maxsize = 1)
+        classified = asyncio.Queue(maxsize = 1)
+        
+        tasks = [
+            asyncio.create_task(self.detect_stage(ready, detected)),
+            asyncio.create_task(self.classify_stage(detected, classified)),
+            asyncio.create_task(self.dump_stage(classified, ready)),
+            asyncio.create_task(self.done.wait()),
+            ]
+        try:
+            finished, _ = await asyncio.wait(tasks, return_when = asyncio.FIRST_COMPLETED)
+            # A stage only finishes on error
+            for task in finished:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
 
 def main():
     try:
-        dump_trash = servo.DumpTrash()
-        dist_sensor = sensor.DistanceSensor()
-        ir_sensor = sensor.IRSensor()
-        picam = camera.Camera()
-        oled_screen = oled.Oled()
-        img_classifier = classify.ImageClassifier(path = "model")
+        dump_trash = timed_startup("servo", servo.DumpTrash)
+        dist_sensor = timed_startup("distance sensor", sensor.DistanceSensor)
+        ir_sensor = timed_startup("ir sensor", sensor.IRSensor)
+        picam = timed_startup("camera", camera.Camera)
+        oled_screen = timed_startup("oled", oled.Oled)
+        # Includes interpreter import, warm up invoke of every model is reported on its own
+        # One item at a time here, so one interpreter using every core (4 on the Pi 4)
+        img_classifier = timed_startup("classifier", classify.ImageClassifier, path = "model", num_threads = os.cpu_count())
+        for stage in img_classifier.stages:
+            startup_times["classifier"] -= stage.warm_up_time or 0
+            startup_times[f"warm up {stage.name}"] = stage.warm_up_time or 0
+        
+        # Shared inference server of the site (TRASH_INFERENCE_SERVER=http://host:9102), this bin's model answers when it's down
+        if os.environ.get("TRASH_INFERENCE_SERVER"):
+            img_classifier = inference_server.RemoteClassifier(os.environ["TRASH_INFERENCE_SERVER"], img_classifier)
         
         IMG_DIM = img_classifier.get_input_shape()
+        
+        # Main frames come from the ring buffer, scored on lores
+        # Preprocessor startup includes the cv2 import
+        timed_startup("frame buffer", picam.start_frame_buffer)
+        preprocessor = timed_startup("preprocessor", classify.ArrayPreprocessor, IMG_DIM, picam.array_color("main"),
+                                     picam.array_size("main"))
     except:
         print("Something went wrong")
     else:
@@ -90,38 +316,63 @@ def main():
     prediction_result_path = "classified-image"
     img_path = f"{prediction_result_path}/images"
     csv_path = f"{prediction_result_path}/img_metadata.csv"
+    db_path = f"{prediction_result_path}/predictions.db"
     
-    # Set up dataframe to save image's informations
-    df = load_dataframe(csv_path)
+    # Set up log to save image's informations, old csv is imported on first run
+    if not os.path.exists(prediction_result_path):
+        os.makedirs(prediction_result_path)
+    report_startup_times(f"{prediction_result_path}/startup_times.jsonl")
+    log = prediction_log.PredictionLog(db_path, csv_path, img_path)
     
-    while True:
-        #time1 = time.time()
-        #oled_screen.display_hardware_info()
-        
-        if dist_sensor.check_object() or ir_sensor.check_object():
-            print("Object Detected!")
-            time.sleep(1)
-            img = picam.capture_img().convert('RGB')
-            
-            img = classify.preprocess_img(img, IMG_DIM)
-            
-            result = img_classifier.classify_image(img)
-            
-            oled_update_result(oled_screen, result)
-            
-            dump_trash_category(dump_trash, result['category'])
-            
-            save_prediction_result(img, result, df, img_path, csv_path)
-            
-            time.sleep(0.5)
-        
-            dist_sensor.update_default()
-            
-            time.sleep(0.5)
-
-        time.sleep(0.1)
-        
-        #print(np.round(time.time() - time1, 3))
+    # Span of every stage, served at http://<bin>:9101/metrics and written for node_exporter
+    tracer = metrics.Tracer()
+    try:
+        metrics_server = metrics.MetricsServer(tracer, port = 9101)
+    except OSError as e:
+        metrics_server = None
+        print("Something went wrong while starting metrics server :", e)
+    
+    # Images go to one folder per day, oldest are deleted past the budget (TRASH_IMAGE_BUDGET_MB, default 2 GB)
+    image_budget = int(float(os.environ.get("TRASH_IMAGE_BUDGET_MB", 2048)) * 1024 * 1024)
+    store = storage.ImageStore(img_path, budget = image_budget, policy = 'oldest', shard = 'date')
+    
+    # Images and results are saved in background
+    writer = prediction_log.PredictionWriter(log, img_path, tracer = tracer, store = store)
+    
+    # Edge triggered IR + adaptive distance sampling, idle CPU stays low
+    # Echo edge timing is opt in (TRASH_ECHO_EDGES=1) until it's checked on the device, polling is the default
+    if os.environ.get("TRASH_ECHO_EDGES") == "1":
+        dist_sensor.enable_edge_timing()
+    watcher = sensor.ObjectWatcher(dist_sensor, ir_sensor)
+    # Frame buffer only copies frames while something happens on the platform
+    watcher.add_activity_listener(picam.set_frame_buffer_active)
+    
+    # Bottom servo only goes home when the next bin needs it
+    dump_scheduler = servo.DumpScheduler(dump_trash)
+    
+    # Same item triggering the sensors again right after a dump that didn't drop it, skip the model
+    retrigger_cache = classify.InferenceCache(capacity = 1, max_distance = 0)
+    
+    pipeline = Pipeline(dump_scheduler, dist_sensor, watcher, picam, oled_screen, img_classifier, preprocessor, writer,
+                        tracer = tracer, metrics_path = f"{prediction_result_path}/metrics.prom", retrigger_cache = retrigger_cache)
+    
+    try:
+        asyncio.run(pipeline.run())
+    finally:
+        watcher.stop()
+        asyncio.run(dump_scheduler.home())
+        print(f"Bottom servo moves {dump_scheduler.n_bottom_moves}, skipped {dump_scheduler.n_bottom_skipped}")
+        if isinstance(img_classifier, inference_server.RemoteClassifier):
+            print(f"Classified by server {img_classifier.n_remote}, on device {img_classifier.n_local}")
+            img_classifier.close()
+        # Flush pending saves, then keep img_metadata.csv up to date for other tools
+        writer.close()
+        log.export_csv(csv_path)
+        log.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        print(tracer.report())
+        print(f"{pipeline.n_items} items, {np.round(pipeline.items_per_minute(), 2)} items/min")
         
 if __name__ == "__main__":
     main()
\ No newline at end of file
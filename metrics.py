@@ -0,0 +1,174 @@
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import contextlib
+import threading
+import socket
+import time
+import os
+
+# Quantiles exported for every stage, from the rolling window
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Latency of one stage : rolling window of the last samples for percentiles,
+# count and sum since start for rates (Prometheus summary)
+class Histogram:
+    def __init__(self, window = 1000):
+        self.samples = deque(maxlen = window)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentiles(self, quantiles = QUANTILES):
+        if not self.samples:
+            return [float('nan')] * len(quantiles)
+        return list(np.percentile(np.fromiter(self.samples, dtype=np.float64), [q * 100 for q in quantiles]))
+
+    def __len__(self):
+        return len(self.samples)
+
+# Records a span (start, duration) for every stage of every item, in perf_counter_ns
+# Safe to use from the event loop and executor threads at the same time
+class Tracer:
+    def __init__(self, window = 1000, max_spans = 5000):
+        self.window = window
+        self.histograms = {}
+        # Last spans, (item, stage, start_ns, duration_ns), item is None outside of an item
+        self.spans = deque(maxlen = max_spans)
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, start_ns, end_ns, item = None):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram(self.window)
+            histogram.add((end_ns - start_ns) / 1e9)
+            self.spans.append((item, stage, start_ns, end_ns - start_ns))
+
+    @contextlib.contextmanager
+    def span(self, stage, item = None):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(stage, start, time.perf_counter_ns(), item)
+
+    def timed(self, stage, fn, *args, item = None):
+        with self.span(stage, item):
+            return fn(*args)
+
+    async def timed_async(self, stage, coro, item = None):
+        with self.span(stage, item):
+            return await coro
+
+    def count(self, name, value = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def item_spans(self, item):
+        with self.lock:
+            return [span for span in self.spans if span[0] == item]
+
+    # Prometheus text format, labels identify the unit in the fleet
+    def prometheus(self, prefix = "trash", labels = None):
+        labels = dict(labels or {})
+        labels.setdefault('unit', socket.gethostname())
+        def label_text(extra = None):
+            items = {**labels, **(extra or {})}
+            return "{" + ",".join(f'{key}="{value}"' for key, value in items.items()) + "}"
+
+        with self.lock:
+            stages = [(stage, histogram.percentiles(), histogram.count, histogram.sum, histogram.max) for stage, histogram in self.histograms.items()]
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+
+        lines = [
+            f"# HELP {prefix}_stage_seconds Latency of every pipeline stage, quantiles over the last samples",
+            f"# TYPE {prefix}_stage_seconds summary",
+            ]
+        for stage, values, count, total, _ in stages:
+            for q, value in zip(QUANTILES, values):
+                lines.append(f"{prefix}_stage_seconds{label_text({'stage' : stage, 'quantile' : q})} {value:.6f}")
+            lines.append(f"{prefix}_stage_seconds_sum{label_text({'stage' : stage})} {total:.6f}")
+            lines.append(f"{prefix}_stage_seconds_count{label_text({'stage' : stage})} {count}")
+        lines.append(f"# TYPE {prefix}_stage_seconds_max gauge")
+        for stage, _, _, _, maximum in stages:
+            lines.append(f"{prefix}_stage_seconds_max{label_text({'stage' : stage})} {maximum:.6f}")
+        for name, value in counters.items():
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total{label_text()} {value}")
+        for name, value in gauges.items():
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name}{label_text()} {value}")
+        return "\n".join(lines) + "\n"
+
+    # For node_exporter textfile collector, file is swapped in so it's never read half written
+    def write_textfile(self, path, **kwargs):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(self.prometheus(**kwargs))
+        os.replace(temp_path, path)
+
+    def report(self):
+        # Table of every stage, ms
+        lines = [f"{'stage':<12}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        with self.lock:
+            stages = [(stage, histogram.count, histogram.percentiles(), histogram.max) for stage, histogram in self.histograms.items()]
+        for stage, count, (p50, p95, p99), maximum in stages:
+            lines.append(f"{stage:<12}{count:>6}{p50 * 1000:>10.1f}{p95 * 1000:>10.1f}{p99 * 1000:>10.1f}{maximum * 1000:>10.1f}")
+        return "\n".join(lines)
+
+# Serve the metrics at http://host:port/metrics from a daemon thread
+class MetricsServer:
+    def __init__(self, tracer, port = 9101, host = "0.0.0.0", **kwargs):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path != "/metrics":
+                    handler.send_error(404)
+                    return
+                body = tracer.prometheus(**kwargs).encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target = self.server.serve_forever, name = "metrics", daemon = True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# Just for testing
+def main():
+    import urllib.request
+    tracer = Tracer()
+    for i in range(20):
+        with tracer.span('sleep', item = i):
+            time.sleep(0.001 * (i % 5))
+        tracer.count('items')
+    server = MetricsServer(tracer, port = 0, host = "127.0.0.1")
+    print(urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics").read().decode())
+    print(tracer.report())
+    server.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
-import board
-import digitalio
-
 from PIL import Image, ImageDraw, ImageFont
-import adafruit_ssd1306
-import subprocess
+import numpy as np
+
+import hardware
+import sysstats
+
+board, digitalio, adafruit_ssd1306 = hardware.oled()
 
 class Oled:
     def __init__(self, WIDTH = 128, HEIGHT = 32, font_size = 16):
@@ -37,6 +38,16 @@ class Oled:
 
             # Load font
             self.font = ImageFont.truetype('PixelOperator.ttf', font_size)
+            
+            # CPU, memory and temperature for the idle screen
+            self.stats = sysstats.SysStats()
+            
+            # Last image and frame sent, only what changed since then goes over I2C
+            self.last_image = None
+            self.last_frame = None
+            self.n_pushes = 0
+            self.n_skipped = 0
+            self.bytes_sent = 0
         
         except:
             print("Something went wrong")
@@ -49,27 +60,80 @@ class Oled:
         self.draw.rectangle((0, 0, self.oled.width, self.oled.height), outline=0, fill=0)
     
     def show_oled(self):
+        # Same drawing as last time, nothing to convert or send
+        image_bytes = self.image.tobytes()
+        if image_bytes == self.last_image:
+            self.n_skipped += 1
+            return
+        self.last_image = image_bytes
+        
         # Display image
         self.oled.image(self.image)
-        self.oled.show()
+        self.push_changes()
+    
+    def push_changes(self):
+        # SSD1306 buffer : control byte 0x40, then one byte per column for every page of 8 rows
+        pages = self.oled.height // 8
+        width = self.oled.width
+        frame = np.frombuffer(bytes(self.oled.buffer[1:]), dtype=np.uint8).reshape(pages, width)
+        last_frame = self.last_frame
+        self.last_frame = frame
+        
+        # Page addressing mode or a driver without raw I2C access, send everything like before
+        if last_frame is None or getattr(self.oled, 'page_addressing', False) or not hasattr(self.oled, 'i2c_device'):
+            self.oled.show()
+            self.n_pushes += 1
+            self.bytes_sent += frame.size
+            return
+        
+        changed = frame != last_frame
+        changed_pages = np.flatnonzero(changed.any(axis=1))
+        if len(changed_pages) == 0:
+            self.n_skipped += 1
+            return
+        
+        # Every window costs 6 address commands (one I2C write each : address + 2 bytes + start/stop),
+        # pick one box around all changes or a window per page
+        windows = []
+        for page in changed_pages:
+            columns = np.flatnonzero(changed[page])
+            windows.append((page, page, columns[0], columns[-1]))
+        changed_columns = np.flatnonzero(changed.any(axis=0))
+        box = (changed_pages[0], changed_pages[-1], changed_columns[0], changed_columns[-1])
+        def cost(window):
+            page0, page1, column0, column1 = window
+            return (page1 - page0 + 1) * (column1 - column0 + 1) + 6 * 4
+        if cost(box) <= sum(cost(window) for window in windows):
+            windows = [box]
+        
+        for page0, page1, column0, column1 in windows:
+            self.write_window(frame, int(page0), int(page1), int(column0), int(column1))
+        self.n_pushes += 1
+    
+    def write_window(self, frame, page0, page1, column0, column1):
+        # Address window, then its bytes in one I2C write (horizontal addressing wraps inside the window)
+        for cmd in (0x21, column0, column1, 0x22, page0, page1):
+            self.oled.write_cmd(cmd)
+        data = frame[page0:page1 + 1, column0:column1 + 1].tobytes()
+        with self.oled.i2c_device:
+            self.oled.i2c_device.write(b'\x40' + data)
+        self.bytes_sent += len(data)
     
     # Contents = array of tuple (text, x, y)
     def display_hardware_info(self):
         self.blank_oled()
         font = self.font
         # Update Display
-        # Shell scripts for system monitoring from here : https://unix.stackexchange.com/questions/119126/command-to-display-memory-usage-disk-usage-and-cpu-load
-        cmd = "top -bn2 | grep '%Cpu' | tail -1 | grep -P '(....|...) id,'|awk '{printf \"CPU:  %.0f%%\", 100-($8/4)}'"
-        CPU = subprocess.check_output(cmd, shell = True )
-        cmd = "free -m | awk 'NR==2{printf \"RAM: %.0f%%\", $3*100/$2 }'"
-        MemUsage = subprocess.check_output(cmd, shell = True )
-        cmd = "vcgencmd measure_temp |cut -f 2 -d '='"
-        Temp = subprocess.check_output(cmd, shell = True )
+        # Read from /proc and /sys, cheap enough to call on every loop
+        stats = self.stats.sample()
+        CPU = "CPU:  --" if stats['cpu'] is None else f"CPU:  {stats['cpu']:.0f}%"
+        MemUsage = "RAM: --" if stats['memory'] is None else f"RAM: {stats['memory']:.0f}%"
+        Temp = "--'C" if stats['temperature'] is None else f"{stats['temperature']:.1f}'C"
         
         # Pi Stats Display
-        self.draw.text((0, 0), str(CPU,'utf-8'), font=font, fill=255)
-        self.draw.text((70, 0), str(Temp,'utf-8'), font=font, fill=255)
-        self.draw.text((0, 16), str(MemUsage,'utf-8'), font=font, fill=255)
+        self.draw.text((0, 0), CPU, font=font, fill=255)
+        self.draw.text((70, 0), Temp, font=font, fill=255)
+        self.draw.text((0, 16), MemUsage, font=font, fill=255)
         self.draw.text((70, 16), "Ready :)" , font=font, fill=255)
         self.show_oled()
             
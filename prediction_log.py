@@ -0,0 +1,233 @@
+import sqlite3
+import argparse
+import threading
+import queue
+import time
+import csv
+import os
+
+# Same columns as img_metadata.csv
+COLUMNS = ['name', 'pred_category', 'pred_subcategory', 'probability', 'classifying_time_ms']
+
+# Columns added after the first version, created on old logs when opened
+# path : image file relative to the image folder, NULL is the flat layout (just the name)
+# evicted : 1 once the image file was deleted to stay in the disk budget, the prediction stays
+EXTRA_COLUMNS = [('path', 'TEXT'), ('evicted', 'INTEGER NOT NULL DEFAULT 0')]
+
+# Append only prediction store, one row per classified image
+# SQLite in WAL mode : inserts don't rewrite history and survive power cut
+class PredictionLog:
+    def __init__(self, path, csv_path = None, img_path = None):
+        is_new = not os.path.exists(path)
+
+        # PredictionWriter hands the connection to its own thread, only one thread uses it at a time
+        self.conn = sqlite3.connect(path, check_same_thread = False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Commit is durable once WAL is synced at checkpoint, good enough for SD card
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            "id INTEGER PRIMARY KEY, "
+            "name TEXT NOT NULL, "
+            "pred_category TEXT, "
+            "pred_subcategory TEXT, "
+            "probability REAL, "
+            "classifying_time_ms REAL)"
+            )
+        existing = [row[1] for row in self.conn.execute("PRAGMA table_info(predictions)")]
+        for column, column_type in EXTRA_COLUMNS:
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE predictions ADD COLUMN {column} {column_type}")
+        self.conn.commit()
+
+        # First run, bring in the old csv history
+        if is_new and csv_path and os.path.exists(csv_path):
+            self.import_csv(csv_path)
+
+        # Sequence counter, only read once at startup
+        last_id = self.conn.execute("SELECT MAX(id) FROM predictions").fetchone()[0]
+        self.next_id = 0 if last_id is None else last_id + 1
+
+        # Don't overwrite images saved without a log entry, shard folders included
+        if is_new and img_path and os.path.exists(img_path):
+            indexes = [image_index(name) for _, _, names in os.walk(img_path) for name in names]
+            self.next_id = max([self.next_id] + [i + 1 for i in indexes if i is not None])
+
+    def next_name(self, offset = 0):
+        return f"image-{self.next_id + offset}.jpeg"
+
+    def append(self, name, result, path = None):
+        return self.append_many([(name, result, path)])[0]
+
+    def append_many(self, items):
+        # One transaction for many rows, names should come from next_name(offset) in the same order
+        # Items are (name, result) or (name, result, path) when the image isn't stored flat
+        rows = []
+        for name, result, *path in items:
+            rows.append((
+                self.next_id + len(rows),
+                name,
+                result['category'],
+                result['sub_category'],
+                float(result['probability']),
+                float(result['time']),
+                path[0] if path else None,
+                ))
+        with self.conn:
+            self.conn.executemany(f"INSERT INTO predictions (id, {', '.join(COLUMNS)}, path) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.next_id += len(rows)
+        return [row[0] for row in rows]
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    def import_csv(self, csv_path):
+        with open(csv_path, newline = '') as f:
+            rows = []
+            for i, line in enumerate(csv.DictReader(f)):
+                index = image_index(line['name'])
+                rows.append((
+                    i if index is None else index,
+                    line['name'],
+                    line['pred_category'],
+                    line['pred_subcategory'],
+                    to_float(line['probability']),
+                    to_float(line['classifying_time_ms']),
+                    ))
+        with self.conn:
+            self.conn.executemany(f"INSERT OR REPLACE INTO predictions (id, {', '.join(COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def eviction_candidates(self, policy = 'oldest', limit = 64):
+        # (id, path) of images still on disk, first to go first
+        # oldest : lowest id, low_value : most confident predictions first, they teach the least when retraining
+        if policy == 'oldest':
+            order = "id"
+        elif policy == 'low_value':
+            order = "probability DESC, id"
+        else:
+            raise ValueError(f"Policy '{policy}' is not valid")
+        return self.conn.execute(
+            f"SELECT id, COALESCE(path, name) FROM predictions WHERE evicted = 0 ORDER BY {order} LIMIT ?", (limit,)
+            ).fetchall()
+
+    def mark_evicted(self, ids):
+        with self.conn:
+            self.conn.executemany("UPDATE predictions SET evicted = 1 WHERE id = ?", [(i,) for i in ids])
+
+    def image_paths(self):
+        # Relative path of every image still on disk, in saving order
+        return [row[0] for row in self.conn.execute("SELECT COALESCE(path, name) FROM predictions WHERE evicted = 0 ORDER BY id")]
+
+    def export_csv(self, csv_path):
+        # Stream rows to a temporary file, then swap it in
+        temp_path = f"{csv_path}.tmp"
+        with open(temp_path, 'w', newline = '') as f:
+            writer = csv.writer(f, lineterminator = '\n')
+            writer.writerow(COLUMNS)
+            writer.writerows(self.conn.execute(f"SELECT {', '.join(COLUMNS)} FROM predictions ORDER BY id"))
+        os.replace(temp_path, csv_path)
+
+    def close(self):
+        self.conn.close()
+
+# Save images and log rows on a background thread so the main loop never waits on storage
+# Queue is bounded, put blocks when the disk can't keep up (backpressure)
+class PredictionWriter:
+    # tracer : optional metrics.Tracer, gets a 'persist' span for every batch written
+    # store : optional storage.ImageStore, images go into its shards and its budget is applied after every batch
+    def __init__(self, log, img_path, max_queue = 16, max_batch = 8, max_delay = 1.0, tracer = None, store = None):
+        self.log = log
+        self.tracer = tracer
+        self.store = store
+        self.img_path = img_path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue(max_queue)
+        self.n_written = 0
+        self.n_failed = 0
+
+        if not os.path.exists(img_path):
+            os.makedirs(img_path)
+
+        self.thread = threading.Thread(target = self.run, name = "prediction-writer", daemon = True)
+        self.thread.start()
+
+    def put(self, image, result, timeout = None):
+        # Image must not be modified after put, pass a copy if the buffer is reused
+        self.queue.put((image, result), timeout = timeout)
+
+    def run(self):
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+
+            # Collect more items for a while, one commit for the whole batch
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout = remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        start = time.perf_counter_ns()
+        try:
+            items = []
+            for i, (image, result) in enumerate(batch):
+                img_name = self.log.next_name(i)
+                if self.store is not None:
+                    items.append((img_name, result, self.store.save(image, img_name)))
+                else:
+                    image.save(f"{self.img_path}/{img_name}")
+                    items.append((img_name, result))
+            self.log.append_many(items)
+            if self.store is not None:
+                self.store.enforce_budget(self.log)
+        except Exception as e:
+            self.n_failed += len(batch)
+            print("Something went wrong while saving predictions :", e)
+        else:
+            self.n_written += len(batch)
+        if self.tracer is not None:
+            self.tracer.record('persist', start, time.perf_counter_ns())
+
+    def close(self, timeout = None):
+        # Write everything still in queue, then stop the thread
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+# image-12.jpeg > 12, None if name doesn't follow the pattern
+def image_index(name):
+    stem = os.path.splitext(os.path.basename(name))[0]
+    index = stem.rsplit("-", 1)[-1]
+    return int(index) if index.isdigit() else None
+
+def to_float(value):
+    return float(value) if value not in (None, '') else None
+
+# Export the log to img_metadata.csv format
+def main():
+    parser = argparse.ArgumentParser(description = "Export prediction log to csv")
+    parser.add_argument("--db", default = "classified-image/predictions.db")
+    parser.add_argument("--output", default = "classified-image/img_metadata.csv")
+    args = parser.parse_args()
+
+    log = PredictionLog(args.db)
+    log.export_csv(args.output)
+    print(f"Exported {len(log)} predictions to {args.output}")
+    log.close()
+
+if __name__ == "__main__":
+    main()
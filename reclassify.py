@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import argparse
+import time
+import os
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+import classify
+import tensor_cache
+import storage
+
+# Group streamed images into batches of n
+def batched(iterable, n):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Cached tensors of every image, in archive order, views into the memory map
+def stream_cached(cache, img_path, workers = None):
+    n_updated, _ = cache.update(img_path, workers)
+    print(f"{n_updated} new images in tensor cache")
+    tensors = cache.open()
+    # Names the cache just indexed, an image saved since has no row yet and waits for the next run
+    for name in cache.names():
+        yield name, tensors[cache.row(name)]
+
+# Re-run the classifier over every saved image and write a fresh prediction table
+# cache_dir : use the tensor cache there (tensor_cache.py) instead of decoding every jpeg
+# n_parallel : batches classified at the same time, up to the classifier's interpreters per stage
+def reclassify(img_classifier, img_path, csv_path, batch_size = 32, workers = None, cache_dir = None, n_parallel = 1):
+    columns = ['name', 'pred_category', 'pred_subcategory','probability', 'classifying_time_ms']
+    size = img_classifier.get_input_shape()
+    # Paths relative to img_path, shard folder included
+    names = storage.list_images(img_path)
+    rows = []
+
+    def add_rows(batch_names, future):
+        for name, result in zip(batch_names, future.result()):
+            rows.append([name, result['category'], result['sub_category'], result['probability'], result['time']])
+        print(f"{len(rows)}/{len(names)} images classified")
+
+    def classify_stream(stream):
+        # A few batches in flight, results are taken in order so rows keep the archive order
+        pending = deque()
+        with ThreadPoolExecutor(n_parallel) as executor:
+            for batch in batched(stream, batch_size):
+                batch_names = [name for name, _ in batch]
+                images = [image for _, image in batch]
+                pending.append((batch_names, executor.submit(img_classifier.classify_batch, images)))
+                if len(pending) > n_parallel:
+                    add_rows(*pending.popleft())
+            while pending:
+                add_rows(*pending.popleft())
+
+    time1 = time.time()
+    if cache_dir:
+        classify_stream(stream_cached(tensor_cache.TensorCache(cache_dir, size), img_path, workers))
+    else:
+        with Pool(workers) as pool:
+            # imap keeps the order and only holds a few batches in memory
+            tasks = ((img_path, name, size) for name in names)
+            classify_stream(pool.imap(tensor_cache.load_tensor, tasks, chunksize = 8))
+    time2 = time.time()
+
+    df = pd.DataFrame(rows, columns = columns)
+    df.to_csv(csv_path, index = False)
+
+    print(f"Classified {len(rows)} images in {np.round(time2-time1, 3)} s")
+    return df
+
+def main():
+    parser = argparse.ArgumentParser(description = "Re-classify saved images with the current model")
+    parser.add_argument("--model-path", default = "model")
+    parser.add_argument("--model-name", default = None, nargs = "+", help = "Several names make a cascade, cheapest first")
+    parser.add_argument("--thresholds", default = [0.8], nargs = "+", type = float, help = "Probability for a cascade stage to answer")
+    parser.add_argument("--result-path", default = "classified-image")
+    parser.add_argument("--output", default = None, help = "Default : img_metadata_rescored.csv next to img_metadata.csv")
+    parser.add_argument("--batch-size", type = int, default = 32)
+    parser.add_argument("--workers", type = int, default = None, help = "Default : number of CPUs")
+    parser.add_argument("--tensor-cache", default = None, help = "Tensor cache folder, built or updated before classifying")
+    parser.add_argument("--cache-distance", type = int, default = None, help = "Reuse results of near duplicate images (hash bits)")
+    parser.add_argument("--interpreters", type = int, default = os.cpu_count(), help = "Batches classified at the same time, default : number of CPUs")
+    parser.add_argument("--threads", type = int, default = 1, help = "Threads of every interpreter")
+    args = parser.parse_args()
+
+    img_path = f"{args.result_path}/images"
+    csv_path = args.output or f"{args.result_path}/img_metadata_rescored.csv"
+
+    cache = None
+    if args.cache_distance is not None:
+        cache = classify.InferenceCache(capacity = 4096, max_distance = args.cache_distance)
+
+    img_classifier = classify.ImageClassifier(path = args.model_path, model_name = args.model_name, batch_size = args.batch_size, cache = cache,
+                                               thresholds = args.thresholds[0] if len(args.thresholds) == 1 else args.thresholds,
+                                               n_interpreters = args.interpreters, num_threads = args.threads)
+    reclassify(img_classifier, img_path, csv_path, batch_size = args.batch_size, workers = args.workers, cache_dir = args.tensor_cache,
+               n_parallel = args.interpreters)
+
+    if cache is not None:
+        print("Cache", cache.stats())
+
+if __name__ == "__main__":
+    main()
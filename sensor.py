@@ -1,7 +1,13 @@
-import RPi.GPIO as GPIO
+import threading
+import bisect
 import time
+from collections import deque
 from statistics import median, mean
 
+import hardware
+
+GPIO = hardware.gpio()
+
 class DistanceSensor:
     def __init__(self, trigger_pin = 23, echo_pin = 24, mode = 'BCM', temp = 32):
         try :
@@ -30,6 +36,19 @@ class DistanceSensor:
 
             # Set trigger to False (Low)
             GPIO.output(self.GPIO_TRIGGER, False)
+            
+            # Echo timing from GPIO edge callbacks, see enable_edge_timing
+            # echo_armed : a ping was sent and its falling edge hasn't come yet
+            self.edge_timing = False
+            self.echo_event = threading.Event()
+            self.echo_armed = False
+            self.echo_start = None
+            self.echo_length = None
+            
+            # Only one ping in the air at a time
+            self.ping_lock = threading.Lock()
+            # Continuous sampling, see start_sampling
+            self.sampler = None
 
             # Allow module to settle
             time.sleep(0.5)
@@ -43,31 +62,65 @@ class DistanceSensor:
         else:
             print("Distance sensor initialized")
             
-    def check_distance(self):
+    def enable_edge_timing(self):
+        # Time the echo with edge callbacks instead of spinning on GPIO.input
+        # Not verified on the device yet, measure_poll stays the default
+        GPIO.add_event_detect(self.GPIO_ECHO, GPIO.BOTH, callback = self.echo_edge)
+        self.edge_timing = True
+    
+    def echo_edge(self, channel):
+        # Edges are told apart by their order after the trigger, not by reading the pin :
+        # a late callback could find the echo already low and take the rise for the fall
+        now = time.perf_counter_ns()
+        if not self.echo_armed:
+            # Fall without a rise, or edges of a ping that timed out
+            return
+        if self.echo_start is None:
+            self.echo_start = now
+        else:
+            self.echo_length = now - self.echo_start
+            self.echo_armed = False
+            self.echo_event.set()
+    
+    def send_trigger(self):
         # Send 10us pulse to trigger
         GPIO.output(self.GPIO_TRIGGER, True)
-        
-        # Wait 10us then turn off trigger
         time.sleep(0.00001)
         GPIO.output(self.GPIO_TRIGGER, False)
-        start = time.time()
+    
+    def measure_edge(self, timeout = 0.05):
+        self.echo_event.clear()
+        self.echo_length = None
+        self.echo_start = None
+        self.echo_armed = True
+        self.send_trigger()
+        
+        # Sleep until the falling edge, no echo means nothing in range
+        if not self.echo_event.wait(timeout) or self.echo_length is None:
+            self.echo_armed = False
+            return self.DEFAULT_DIST
+        return self.echo_length / 1e9 * self.speedSound / 2
+    
+    def measure_poll(self):
+        self.send_trigger()
+        start = time.perf_counter_ns()
         stop = 0
 
         # Start time before echo picked up sounds
         i = 0
         while GPIO.input(self.GPIO_ECHO) == 0 and i < 10000:
-            start = time.time()
+            start = time.perf_counter_ns()
             i += 1
 
         # Stop time after echo picked up sounds
         while GPIO.input(self.GPIO_ECHO)==1:
-            stop = time.time()
+            stop = time.perf_counter_ns()
         
         if stop == 0:
             return self.DEFAULT_DIST
         
-        # Calculate pulse length
-        elapsed = stop-start
+        # Calculate pulse length (ns > s)
+        elapsed = (stop-start) / 1e9
 
         # Distance pulse travelled in that time is time
         # Multiplied by the speed of sound
@@ -75,13 +128,38 @@ class DistanceSensor:
         distance = elapsed * self.speedSound
 
         # That was the distance there and back so halve the value
-        distance = distance / 2
+        return distance / 2
+    
+    def measure(self):
+        # Single reading, caller takes care of the time between pings
+        with self.ping_lock:
+            if self.edge_timing:
+                return self.measure_edge()
+            return self.measure_poll()
+    
+    def check_distance(self):
+        # Sampler is pinging already, wait for its next reading instead
+        if self.sampler is not None:
+            return self.sampler.next_sample()
+        
+        distance = self.measure()
         
         # Need time for the sensors to settle down
         time.sleep(0.01)
         
         return distance
     
+    def start_sampling(self, **kwargs):
+        # Keep measuring in background, queries are answered from the running window
+        if self.sampler is None:
+            self.sampler = DistanceSampler(self, **kwargs)
+        return self.sampler
+    
+    def stop_sampling(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+    
     def object_present(self, dist, error_margin = 3.0):
         # The reading is volatile, need error margin to compensate
         # dist < default if the distance sensor bounce of the object
@@ -90,7 +168,13 @@ class DistanceSensor:
         return dist < self.DEFAULT_DIST - error_margin or dist > self.DEFAULT_DIST + error_margin
 
     def check_object(self, n_check = 10):
-        dist = median([self.check_distance() for _ in range(n_check)])
+        if self.sampler is not None:
+            # Median of the running window, no need to wait for new readings
+            dist = self.sampler.median()
+            if dist is None:
+                return False
+        else:
+            dist = median([self.check_distance() for _ in range(n_check)])
         is_object_present = self.object_present(dist)
             
         print(dist, self.DEFAULT_DIST)
@@ -98,10 +182,158 @@ class DistanceSensor:
         return is_object_present
 
     def update_default(self, error_margin = 2.0, n_check = 10):     
-        new_default_dist = median([self.check_distance() for _ in range(n_check)])
+        if self.sampler is not None:
+            # Platform just moved, only trust readings taken from now on
+            new_default_dist = self.sampler.fresh_median(n_check // 2)
+            # Readings still moving around, keep the old default
+            if new_default_dist is None or self.sampler.mad() > error_margin / 2:
+                return
+        else:
+            new_default_dist = median([self.check_distance() for _ in range(n_check)])
         if abs(self.DEFAULT_DIST - new_default_dist) < error_margin:
             self.DEFAULT_DIST = new_default_dist
 
+# Median and median absolute deviation of the last n values
+# Values are kept in arrival order (ring buffer) and in sorted order (bisect)
+class RollingMedian:
+    def __init__(self, size = 15):
+        self.size = size
+        self.values = deque(maxlen = size)
+        self.sorted = []
+    
+    def __len__(self):
+        return len(self.values)
+    
+    def add(self, value):
+        if len(self.values) == self.size:
+            oldest = self.values[0]
+            del self.sorted[bisect.bisect_left(self.sorted, oldest)]
+        self.values.append(value)
+        bisect.insort(self.sorted, value)
+    
+    def clear(self):
+        self.values.clear()
+        self.sorted.clear()
+    
+    def median(self):
+        n = len(self.sorted)
+        if n == 0:
+            return None
+        if n % 2:
+            return self.sorted[n // 2]
+        return (self.sorted[n // 2 - 1] + self.sorted[n // 2]) / 2
+    
+    def mad(self):
+        # Distances to the median are already sorted on each side of it, merge them up to the middle
+        n = len(self.sorted)
+        if n == 0:
+            return None
+        m = self.median()
+        split = bisect.bisect_left(self.sorted, m)
+        left, right = split - 1, split
+        deviations = []
+        while len(deviations) < n // 2 + 1:
+            left_dev = m - self.sorted[left] if left >= 0 else float('inf')
+            right_dev = self.sorted[right] - m if right < n else float('inf')
+            if left_dev <= right_dev:
+                deviations.append(left_dev)
+                left -= 1
+            else:
+                deviations.append(right_dev)
+                right += 1
+        if n % 2:
+            return deviations[n // 2]
+        return (deviations[n // 2 - 1] + deviations[n // 2]) / 2
+
+# Measure distance continuously on a background thread
+# Interval grows while readings are steady and drops back to min_interval on any change
+class DistanceSampler:
+    def __init__(self, dist_sensor, window_size = 15, min_interval = 0.03, max_interval = 0.5, backoff = 1.5, activity_margin = 1.0):
+        self.dist_sensor = dist_sensor
+        self.window = RollingMedian(window_size)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.activity_margin = activity_margin
+        self.interval = min_interval
+        
+        self.latest = None
+        self.n_samples = 0
+        self.new_sample = threading.Condition()
+        self.wake = threading.Event()
+        self.listeners = []
+        self.stopped = False
+        
+        self.thread = threading.Thread(target = self.run, name = "distance-sampler", daemon = True)
+        self.thread.start()
+    
+    def add_listener(self, callback):
+        # callback(distance) after every reading, on the sampler thread
+        self.listeners.append(callback)
+    
+    def run(self):
+        while not self.stopped:
+            dist = self.dist_sensor.measure()
+            
+            with self.new_sample:
+                last_median = self.window.median()
+                self.window.add(dist)
+                self.latest = dist
+                self.n_samples += 1
+                self.new_sample.notify_all()
+            
+            # Something moved, sample fast, otherwise slow down
+            active = last_median is None or abs(dist - last_median) > self.activity_margin or self.dist_sensor.object_present(dist)
+            if active:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+            
+            for callback in self.listeners:
+                callback(dist)
+            
+            # boost or stop cuts the sleep short
+            self.wake.wait(self.interval)
+            self.wake.clear()
+    
+    def boost(self):
+        # Back to fast sampling right now
+        self.interval = self.min_interval
+        self.wake.set()
+    
+    def median(self):
+        with self.new_sample:
+            return self.window.median()
+    
+    def mad(self):
+        with self.new_sample:
+            return self.window.mad()
+    
+    def next_sample(self, timeout = 1.0):
+        with self.new_sample:
+            n = self.n_samples
+            self.boost()
+            self.new_sample.wait_for(lambda: self.n_samples > n or self.stopped, timeout)
+            return self.latest
+    
+    def reset(self):
+        # Forget old readings, e.g. after the platform moved
+        with self.new_sample:
+            self.window.clear()
+    
+    def fresh_median(self, n, timeout = 1.0):
+        # Median of n readings taken after this call
+        self.reset()
+        self.boost()
+        with self.new_sample:
+            self.new_sample.wait_for(lambda: len(self.window) >= n or self.stopped, timeout)
+            return self.window.median()
+    
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+        self.thread.join()
+
 class IRSensor:
     def __init__(self, ir_pin = 26, mode = 'BCM'):
         try:
@@ -132,6 +364,89 @@ class IRSensor:
     def check_object(self):
         # GPIO.input(GPIO_IR) true when there is no object
         return not GPIO.input(self.GPIO_IR)
+    
+    def enable_events(self, callback, bouncetime = 50):
+        # Call callback(channel) when an object comes in front of the sensor (high > low)
+        GPIO.add_event_detect(self.GPIO_IR, GPIO.FALLING, callback = callback, bouncetime = bouncetime)
+    
+    def disable_events(self):
+        GPIO.remove_event_detect(self.GPIO_IR)
+
+# Wait for an object without polling every 100 ms
+# IR sensor wakes the watcher through GPIO edge callback
+# Distance sensor sampler reports every reading, its interval grows while idle and resets on activity
+class ObjectWatcher:
+    def __init__(self, dist_sensor, ir_sensor, min_samples = 5, **sampler_kwargs):
+        self.dist_sensor = dist_sensor
+        self.ir_sensor = ir_sensor
+        # Readings needed in the window before trusting its median
+        self.min_samples = min_samples
+        
+        # Set when an object is confirmed, at detect_time_ns (perf_counter_ns)
+        self.detected = threading.Event()
+        self.detect_time_ns = None
+        # Cleared while paused (servo moving or default distance updating)
+        self.running = threading.Event()
+        self.running.set()
+        
+        # Something moving on the platform, activity listeners get every change
+        self.active = False
+        self.activity_listeners = []
+        
+        self.sampler = dist_sensor.start_sampling(**sampler_kwargs)
+        self.sampler.add_listener(self.on_sample)
+        self.ir_sensor.enable_events(self.ir_edge)
+    
+    def add_activity_listener(self, callback):
+        # callback(active) when the platform goes from still to active or back, e.g. camera frame buffer
+        self.activity_listeners.append(callback)
+    
+    def set_active(self, active):
+        if active != self.active:
+            self.active = active
+            for callback in self.activity_listeners:
+                callback(active)
+    
+    def ir_edge(self, channel):
+        if self.running.is_set() and self.ir_sensor.check_object():
+            self.set_active(True)
+            self.set_detected()
+    
+    def on_sample(self, dist):
+        # Paused : an item is being handled, activity stays as it was when it was detected
+        if not self.running.is_set():
+            return
+        # Sampler only runs at full speed while readings change or an object is present
+        self.set_active(self.sampler.interval <= self.sampler.min_interval)
+        if len(self.sampler.window) < self.min_samples:
+            return
+        if self.dist_sensor.object_present(dist) and self.dist_sensor.check_object():
+            self.set_detected()
+    
+    def set_detected(self):
+        # Keep the time of the first detection, the pipeline measures how late it noticed
+        if not self.detected.is_set():
+            self.detect_time_ns = time.perf_counter_ns()
+            self.detected.set()
+    
+    def wait(self, timeout = None):
+        # True if an object is present
+        return self.detected.wait(timeout)
+    
+    def pause(self):
+        self.running.clear()
+    
+    def resume(self):
+        # Readings taken while the platform moved are useless, start a new window
+        self.detected.clear()
+        self.sampler.reset()
+        self.running.set()
+        self.sampler.boost()
+    
+    def stop(self):
+        self.running.clear()
+        self.ir_sensor.disable_events()
+        self.dist_sensor.stop_sampling()
 
 # Just for testing
 def main():
@@ -1,12 +1,71 @@
-import RPi.GPIO as GPIO
 import time
 import asyncio
+import copy
+import json
+import os
+
+import hardware
+
+GPIO = hardware.gpio()
+
+# Hand-tuned motion, used until the unit is calibrated with calibrate_servo.py
+# stuck_time : top servo not back home after n second is stuck
+# bottom_home_time : bottom servo drive time when its position is unknown (startup)
+# Every dump position : bottom_time the bottom servo is driven there (and back),
+# top_mode + top_spin_time the speed and blind spin time of the top servo, hold_time for the front dump
+DEFAULT_PROFILE = {
+    'stuck_time' : 5.0,
+    'bottom_home_time' : 2,
+    'positions' : {
+        'front' : {'bottom_time' : 2, 'hold_time' : 1, 'top_mode' : 'slow', 'top_spin_time' : 0.2},
+        'front_left' : {'bottom_time' : 2, 'top_mode' : 'slow', 'top_spin_time' : 0.2},
+        'front_right' : {'top_mode' : 'slow', 'top_spin_time' : 0.2},
+        'back_left' : {'top_mode' : 'slow', 'top_spin_time' : 0.2},
+        'back_right' : {'bottom_time' : 2, 'top_mode' : 'slow', 'top_spin_time' : 0.2},
+        },
+    }
+
+# Calibrated profile of this unit on top of the defaults, missing keys keep the hand-tuned value
+def load_profile(path = None):
+    profile = copy.deepcopy(DEFAULT_PROFILE)
+    if path and os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+        for key, value in saved.items():
+            if key == 'positions':
+                for position, motion in value.items():
+                    profile['positions'].setdefault(position, {}).update(motion)
+            else:
+                profile[key] = value
+    return profile
+
+# Bottom servo pose every dump position needs
+BOTTOM_POSE = {
+    'front' : 'clockwise',
+    'front_left' : 'counter',
+    'front_right' : 'default',
+    'back_left' : 'default',
+    'back_right' : 'counter',
+    }
+
+# Top servo direction tipping the trash at every dump position, front keeps the top servo home
+TOP_DIRECTION = {
+    'front' : None,
+    'front_left' : 'clockwise',
+    'front_right' : 'counter',
+    'back_left' : 'clockwise',
+    'back_right' : 'counter',
+    }
 
 class DumpTrash:
-    def __init__(self, door_sensor_pin = 12, top_servo_pin = 16, bottom_servo_pin = 20, mode = 'BCM'):
+    # home : move servos to default position now, pass False when created inside a running event loop
+    # and await servo_default_pos() instead
+    # profile_path : motion profile written by calibrate_servo.py, hand-tuned defaults if it doesn't exist
+    def __init__(self, door_sensor_pin = 12, top_servo_pin = 16, bottom_servo_pin = 20, mode = 'BCM', home = True,
+                 profile_path = "servo_profile.json"):
         try:
             self.DOOR_SENSOR = door_sensor_pin
-            self.loop = asyncio.get_event_loop()
+            self.profile = load_profile(profile_path)
             
             # Speed settings for top servo
             self.top_servo_duty = {
@@ -38,6 +97,15 @@ class DumpTrash:
             # Set door sensor
             GPIO.setup(self.DOOR_SENSOR, GPIO.IN, pull_up_down=GPIO.PUD_UP)
             
+            # Circuit closing wakes up the coroutines waiting for the top servo, polling is only a fallback
+            # (event loop, asyncio.Event) of every waiting coroutine
+            self.door_waiters = set()
+            self.door_events = True
+            try:
+                GPIO.add_event_detect(self.DOOR_SENSOR, GPIO.FALLING, callback = self.door_edge)
+            except RuntimeError:
+                self.door_events = False
+            
             # Set top servo
             GPIO.setup(top_servo_pin, GPIO.OUT)
             self.top_servo = GPIO.PWM(top_servo_pin, 50)
@@ -51,14 +119,26 @@ class DumpTrash:
             # Set default current top servo duty information
             self.current_top_servo_duty = self.top_servo_duty['stop']
             
-            #self.loop.run_until_complete(self.top_servo_clockwise(spin_time = 120))
+            # Bottom servo pose ('default', 'clockwise', 'counter'), None until it is driven somewhere
+            self.bottom_pose = None
+            
+            #asyncio.run(self.top_servo_clockwise(spin_time = 120))
             
             # If top servo does't come back for n second, assume it is stuck
-            self.stuck_time = 5.0
+            self.stuck_time = self.profile['stuck_time']
+            
+            # Dump coroutine of every position
+            self.dump_positions = {
+                'front' : self._dump_trash_front,
+                'front_left' : self._dump_trash_front_left,
+                'front_right' : self._dump_trash_front_right,
+                'back_left' : self._dump_trash_back_left,
+                'back_right' : self._dump_trash_back_right,
+                }
             
             # Set all servo to default positions
-            self.loop.run_until_complete(self.bottom_servo_default_pos())
-            self.loop.run_until_complete(self.top_servo_default_pos())
+            if home:
+                asyncio.run(self.servo_default_pos())
             
         except:
             # Not very helpful, sorry :(
@@ -80,20 +160,39 @@ class DumpTrash:
         # True if circuit closed
         return not GPIO.input(self.DOOR_SENSOR)
     
-    def wait_for_default_pos(self, refresh = 0.01, delay = 0.0):
+    def door_edge(self, channel):
+        # Called from GPIO thread, hand the edge over to every waiting event loop
+        for loop, closed in list(self.door_waiters):
+            loop.call_soon_threadsafe(closed.set)
+    
+    async def wait_for_default_pos(self, refresh = 0.01, delay = 0.0):
         # Add delay before checking, otherwise, the servo won't turn
-        time.sleep(delay)
-        max_iter = self.stuck_time / refresh
-        i = 0
-        while not self.check_door_sensor() and i < max_iter:
-            time.sleep(refresh)
-            i += 1
-  
-        # Top servo stuck
-        if i >= max_iter:
-            self.unstuck_top_servo()
+        await asyncio.sleep(delay)
+        
+        # Edge wakes us up right away, poll less often when edges are available
+        if self.door_events:
+            refresh = max(refresh, 0.05)
+        loop = asyncio.get_running_loop()
+        closed = asyncio.Event()
+        waiter = (loop, closed)
+        self.door_waiters.add(waiter)
+        try:
+            deadline = loop.time() + self.stuck_time
+            while not self.check_door_sensor():
+                remaining = deadline - loop.time()
+                # Top servo stuck
+                if remaining <= 0:
+                    await self.unstuck_top_servo()
+                    return
+                try:
+                    await asyncio.wait_for(closed.wait(), min(refresh, remaining))
+                except asyncio.TimeoutError:
+                    pass
+                closed.clear()
+        finally:
+            self.door_waiters.discard(waiter)
             
-    def soft_stop_top_servo(self):
+    async def soft_stop_top_servo(self):
         stop_duty = self.top_servo_duty['stop']
         
         # If servo going clockwise, then counter, vice versa
@@ -103,16 +202,16 @@ class DumpTrash:
         
         # Stop > counter > stop
         self.change_duty_top_servo(stop_duty)
-        time.sleep(0.07)
+        await asyncio.sleep(0.07)
         self.change_duty_top_servo(counter_duty)
-        time.sleep(0.02)
+        await asyncio.sleep(0.02)
         self.change_duty_top_servo(stop_duty)
-        time.sleep(0.01)
+        await asyncio.sleep(0.01)
     
-    def hard_stop_top_servo(self):
+    async def hard_stop_top_servo(self):
         stop_duty = self.top_servo_duty['stop']
         self.change_duty_top_servo(stop_duty)
-        time.sleep(0.1)
+        await asyncio.sleep(0.1)
         
     async def top_servo_clockwise(self, spin_time = 0.2, mode = 'fast'):
         # Select top servo clockise spin speed mode
@@ -127,7 +226,7 @@ class DumpTrash:
         else:
             raise ValueError(f'Mode {mode} is not available')
         
-        return self.spin_top_servo(duty, spin_time = spin_time)
+        return await self.spin_top_servo(duty, spin_time = spin_time)
         
     async def top_servo_counter(self, spin_time = 0.2, mode = 'fast'):
         # Select top servo counter spin speed mode
@@ -143,16 +242,16 @@ class DumpTrash:
         else:
             raise ValueError(f'Mode {mode} is not available')
         
-        return self.spin_top_servo(duty, spin_time = spin_time)
+        return await self.spin_top_servo(duty, spin_time = spin_time)
     
-    def spin_top_servo(self, duty, spin_time = 0):
+    async def spin_top_servo(self, duty, spin_time = 0):
         # Spin top servo
         self.change_duty_top_servo(duty)
         
         # Spin as long as spin_time
-        time.sleep(spin_time)
+        await asyncio.sleep(spin_time)
             
-        self.wait_for_default_pos()
+        await self.wait_for_default_pos()
         
         # Use soft stop while spinning fast
         '''
@@ -167,7 +266,7 @@ class DumpTrash:
         if(self.check_door_sensor()):
             # Check twice wether the top servo is in default position.
             self.temp_duty = self.current_top_servo_duty
-            self.hard_stop_top_servo()
+            await self.hard_stop_top_servo()
             if(self.check_door_sensor()):
                 #print('ready')
                 return True
@@ -189,61 +288,91 @@ class DumpTrash:
             self.change_duty_top_servo(very_slow_duty)
             
         # Delay 0 asumming the servo currently not in range of door sensor
-        self.wait_for_default_pos(delay = 0)
+        await self.wait_for_default_pos(delay = 0)
         
         # Recursive
         await self.top_servo_default_pos(n_recursion = n_recursion + 1)
 
-    async def bottom_servo_default_pos(self, spin_time = 2):
-        self.bottom_servo.ChangeDutyCycle(self.bottom_servo_duty['default'])
+    async def move_bottom_servo(self, pose, spin_time = 2):
+        # Bottom servo has no feedback, pose is only known once it was driven long enough
+        self.bottom_pose = None
+        self.bottom_servo.ChangeDutyCycle(self.bottom_servo_duty[pose])
         await asyncio.sleep(spin_time)
         self.bottom_servo.ChangeDutyCycle(0)
+        self.bottom_pose = pose
+
+    async def bottom_servo_default_pos(self, spin_time = 2):
+        await self.move_bottom_servo('default', spin_time)
         
     async def bottom_servo_clockwise_pos(self, spin_time = 2):
-        self.bottom_servo.ChangeDutyCycle(self.bottom_servo_duty['clockwise'])
-        await asyncio.sleep(spin_time)
-        self.bottom_servo.ChangeDutyCycle(0)
+        await self.move_bottom_servo('clockwise', spin_time)
         
     async def bottom_servo_counter_pos(self, spin_time = 2):
-        self.bottom_servo.ChangeDutyCycle(self.bottom_servo_duty['counter'])
-        await asyncio.sleep(spin_time)
-        self.bottom_servo.ChangeDutyCycle(0)
+        await self.move_bottom_servo('counter', spin_time)
     
-    async def servo_default_pos(self):
-        tasks = [self.bottom_servo_default_pos(), self.top_servo_default_pos()]
+    def bottom_travel_time(self, start, end):
+        # Drive time between two bottom poses, from the calibrated time of the dumps using them
+        if start == end:
+            return 0
+        if start is None or end is None:
+            return self.profile['bottom_home_time']
+        positions = self.profile['positions']
+        def from_default(pose):
+            if pose == 'default':
+                return 0
+            return max(motion.get('bottom_time', 0) for position, motion in positions.items() if BOTTOM_POSE[position] == pose)
+        return from_default(start) + from_default(end)
+    
+    async def servo_default_pos(self, bottom_time = None):
+        # Bottom position unknown, drive it long enough for the longest travel
+        if bottom_time is None:
+            bottom_time = self.profile['bottom_home_time']
+        tasks = [self.bottom_servo_default_pos(spin_time = bottom_time), self.top_servo_default_pos()]
         await asyncio.gather(*tasks)
         await self.top_servo_default_pos()
      
     async def _dump_trash_front(self):
+        motion = self.profile['positions']['front']
+        
         # To hold trash
         async def hold_top_servo():
-            await asyncio.sleep(1)
+            await asyncio.sleep(motion['hold_time'])
             if not self.check_door_sensor():
-                await self.top_servo_counter(mode = 'slow')
+                await self.top_servo_counter(spin_time = motion['top_spin_time'], mode = motion['top_mode'])
         
-        tasks = [self.bottom_servo_clockwise_pos(), hold_top_servo()]
+        tasks = [self.bottom_servo_clockwise_pos(spin_time = motion['bottom_time']), hold_top_servo()]
         await asyncio.gather(*tasks)
-        await self.servo_default_pos()
+        await self.servo_default_pos(motion['bottom_time'])
         
     async def _dump_trash_front_left(self):
-        tasks = [self.bottom_servo_counter_pos(), self.top_servo_clockwise(mode = 'slow')]
+        motion = self.profile['positions']['front_left']
+        tasks = [
+            self.bottom_servo_counter_pos(spin_time = motion['bottom_time']),
+            self.top_servo_clockwise(spin_time = motion['top_spin_time'], mode = motion['top_mode']),
+            ]
         await asyncio.gather(*tasks)
-        await self.servo_default_pos()
+        await self.servo_default_pos(motion['bottom_time'])
     
     async def _dump_trash_front_right(self):
-        await self.top_servo_counter(mode = 'slow')
+        motion = self.profile['positions']['front_right']
+        await self.top_servo_counter(spin_time = motion['top_spin_time'], mode = motion['top_mode'])
         await self.top_servo_default_pos()
     
     async def _dump_trash_back_left(self):
-        await self.top_servo_clockwise(mode = 'slow')
+        motion = self.profile['positions']['back_left']
+        await self.top_servo_clockwise(spin_time = motion['top_spin_time'], mode = motion['top_mode'])
         await self.top_servo_default_pos()
     
     async def _dump_trash_back_right(self):
-        tasks = [self.bottom_servo_counter_pos(), self.top_servo_counter(mode = 'slow')]
+        motion = self.profile['positions']['back_right']
+        tasks = [
+            self.bottom_servo_counter_pos(spin_time = motion['bottom_time']),
+            self.top_servo_counter(spin_time = motion['top_spin_time'], mode = motion['top_mode']),
+            ]
         await asyncio.gather(*tasks)
-        await self.servo_default_pos()
+        await self.servo_default_pos(motion['bottom_time'])
     
-    def unstuck_top_servo(self):
+    async def unstuck_top_servo(self):
         stop_duty = self.top_servo_duty['stop']
         slow_counter_duty = self.top_servo_duty['slow_clockwise']
         fast_duty = self.top_servo_duty['fast_counter']
@@ -254,29 +383,86 @@ class DumpTrash:
             fast_duty = self.top_servo_duty['fast_clockwise']
         
         self.change_duty_top_servo(slow_counter_duty)
-        time.sleep(0.4)
+        await asyncio.sleep(0.4)
         self.change_duty_top_servo(fast_duty)
-        time.sleep(1)
+        await asyncio.sleep(1)
+    
+    # Awaitable dump, the event loop keeps running while servos move
+    async def dump(self, position):
+        if position not in self.dump_positions:
+            raise ValueError(f"Position {position} is not valid")
+        await self.dump_positions[position]()
                
-    # Work around so asynchronous function can be called synchronously (normal)
+    # Synchronous version for scripts without an event loop, don't call from a running loop
     def dump_trash_front(self):
-        return self.loop.run_until_complete(self._dump_trash_front())
+        return asyncio.run(self.dump('front'))
     
     def dump_trash_front_left(self):
-        return self.loop.run_until_complete(self._dump_trash_front_left())
+        return asyncio.run(self.dump('front_left'))
     
     def dump_trash_front_right(self):
-        return self.loop.run_until_complete(self._dump_trash_front_right())
+        return asyncio.run(self.dump('front_right'))
     
     def dump_trash_back_left(self):
-        return self.loop.run_until_complete(self._dump_trash_back_left())
+        return asyncio.run(self.dump('back_left'))
     
     def dump_trash_back_right(self):
-        return self.loop.run_until_complete(self._dump_trash_back_right())
+        return asyncio.run(self.dump('back_right'))
     
     def shutdown_servo(self):
+        if self.door_events:
+            GPIO.remove_event_detect(self.DOOR_SENSOR)
         self.top_servo.stop()
         self.bottom_servo.stop()
+
+# Plans every dump from the current servo pose instead of going back home after each one
+# Top servo always comes home, it holds the next trash
+# Bottom servo stays where the last dump left it, a run of the same bin never moves it
+# Front is the exception : trash slides off while the chute is turned clockwise, so it can't stay there
+class DumpScheduler:
+    def __init__(self, dump_trash):
+        self.dump_trash = dump_trash
+        self.n_bottom_moves = 0
+        self.n_bottom_skipped = 0
+
+    async def move_bottom(self, pose):
+        if self.dump_trash.bottom_pose == pose:
+            self.n_bottom_skipped += 1
+            return
+        spin_time = self.dump_trash.bottom_travel_time(self.dump_trash.bottom_pose, pose)
+        await self.dump_trash.move_bottom_servo(pose, spin_time)
+        self.n_bottom_moves += 1
+
+    async def dump(self, position):
+        if position not in BOTTOM_POSE:
+            raise ValueError(f"Position {position} is not valid")
+        motion = self.dump_trash.profile['positions'][position]
+        pose = BOTTOM_POSE[position]
+
+        if position == 'front':
+            # Drop happens on the way from default to clockwise, then the chute has to come back
+            await self.move_bottom('default')
+            await self.dump_trash.dump('front')
+            self.n_bottom_moves += 2
+            return
+
+        if TOP_DIRECTION[position] == 'clockwise':
+            spin = self.dump_trash.top_servo_clockwise(spin_time = motion['top_spin_time'], mode = motion['top_mode'])
+        else:
+            spin = self.dump_trash.top_servo_counter(spin_time = motion['top_spin_time'], mode = motion['top_mode'])
+
+        if self.dump_trash.bottom_pose in ('default', pose):
+            # Same moves as the original dump, the chute turns while the top servo tips the trash
+            await asyncio.gather(self.move_bottom(pose), spin)
+        else:
+            # Chute coming from another bin must be in place before the trash falls
+            await self.move_bottom(pose)
+            await spin
+        await self.dump_trash.top_servo_default_pos()
+
+    async def home(self):
+        await self.move_bottom('default')
+        await self.dump_trash.top_servo_default_pos()
 '''
         *  *
      * bl  br *
@@ -0,0 +1,517 @@
+from PIL import Image
+import numpy as np
+import threading
+import random
+import types
+import time
+import csv
+import os
+
+# Simulated hardware for running the bin anywhere but on the Raspberry Pi
+# Select it with hardware.use_backend('sim') or TRASH_BACKEND=sim
+# Everything runs on wall clock time, the servos take as long as the real ones
+
+# Pins used by sensor.py and servo.py defaults
+PINS = {
+    'trigger' : 23,
+    'echo' : 24,
+    'ir' : 26,
+    'door' : 12,
+    'top_servo' : 16,
+    'bottom_servo' : 20,
+    }
+
+# Speed of sound in cm/s
+SPEED_SOUND = 34300
+
+# Continuous rotation servo turning the top platform, duty 7.0 stops it
+# Speed grows linearly with distance from stop duty and saturates at max_speed (rev/s)
+class TopServoModel:
+    def __init__(self, stop_duty = 7.0, max_speed = 1.0, full_speed_offset = 2.0, deadband = 0.2, home_window = 0.03, drop_angle = 0.1):
+        self.stop_duty = stop_duty
+        self.max_speed = max_speed
+        self.full_speed_offset = full_speed_offset
+        self.deadband = deadband
+        # Door sensor is closed while platform is within home_window revolution from home
+        self.home_window = home_window
+        # Item slides off once platform turns further than drop_angle revolution
+        self.drop_angle = drop_angle
+        self.angle = 0.0
+        self.speed = 0.0
+        self.last_time = time.monotonic()
+
+    def duty_to_speed(self, duty):
+        # Duty 0 means no pulse, the servo stops
+        offset = duty - self.stop_duty
+        if duty == 0 or abs(offset) < self.deadband:
+            return 0.0
+        return self.max_speed * max(-1.0, min(1.0, offset / self.full_speed_offset))
+
+    def advance(self):
+        now = time.monotonic()
+        self.angle += self.speed * (now - self.last_time)
+        self.last_time = now
+
+    def set_duty(self, duty):
+        self.advance()
+        self.speed = self.duty_to_speed(duty)
+
+    def distance_from_home(self):
+        self.advance()
+        position = self.angle % 1.0
+        return min(position, 1.0 - position)
+
+    def at_home(self):
+        return self.distance_from_home() < self.home_window
+
+    def tilted(self):
+        return self.distance_from_home() > self.drop_angle
+
+# Positional servo turning the bottom chute, duty 2.5 - 12.5 is 0 - 180 degree
+class BottomServoModel:
+    def __init__(self, default_duty = 6.75, speed = 300.0, drop_angle = 20.0):
+        # Degree per second, 0.2 s per 60 degree
+        self.speed = speed
+        self.drop_angle = drop_angle
+        self.default_angle = self.duty_to_angle(default_duty)
+        self.start_angle = self.default_angle
+        self.target_angle = self.default_angle
+        self.start_time = time.monotonic()
+
+    @staticmethod
+    def duty_to_angle(duty):
+        return (duty - 2.5) / 10 * 180
+
+    def angle(self):
+        travel = abs(self.target_angle - self.start_angle)
+        if travel == 0:
+            return self.target_angle
+        done = min(1.0, (time.monotonic() - self.start_time) * self.speed / travel)
+        return self.start_angle + (self.target_angle - self.start_angle) * done
+
+    def set_duty(self, duty):
+        current = self.angle()
+        self.start_angle = current
+        self.start_time = time.monotonic()
+        # Duty 0 means no pulse, the servo stays where it is
+        self.target_angle = current if duty == 0 else self.duty_to_angle(duty)
+
+    def turned(self):
+        return abs(self.angle() - self.default_angle) > self.drop_angle
+
+    def moving(self):
+        return self.angle() != self.target_angle
+
+    # Front dump turns the chute clockwise (lower duty), trash slides off there
+    # On the counter side the chute only guides trash tipped by the top platform
+    def front_open(self):
+        return self.angle() < self.default_angle - self.drop_angle
+
+# Platform, item and sensors shared by every simulated device
+class World:
+    def __init__(self, img_path = "images", csv_path = "img_metadata.csv", baseline = 20.0, item_height = 8.0, noise = 0.3):
+        self.lock = threading.RLock()
+        self.pins = dict(PINS)
+        self.img_path = img_path
+        self.csv_path = csv_path
+        # Distance from ultrasonic sensor to empty platform (cm), item makes it shorter
+        self.baseline = baseline
+        self.item_height = item_height
+        self.noise = noise
+        self.trace = None
+        self.trace_index = 0
+
+        self.top = TopServoModel()
+        self.bottom = BottomServoModel()
+
+        # Name of the image of the item currently on the platform
+        self.item = None
+        self.image_names = None
+        self.image_index = 0
+        self.n_placed = 0
+        self.n_dropped = 0
+        self.item_dropped = threading.Event()
+
+        # Echo pulse (rise, fall) of the last trigger
+        self.echo = (0.0, 0.0)
+        self.echo_level = None
+
+    def load_trace(self, path):
+        # Recorded empty platform readings, one distance per line, replayed in a loop
+        with open(path) as f:
+            self.trace = [float(line) for line in f if line.strip()]
+        self.trace_index = 0
+
+    def next_image_name(self):
+        if self.image_names is None:
+            self.image_names = sorted(name for name in os.listdir(self.img_path) if name.endswith((".jpeg", ".jpg")))
+        name = self.image_names[self.image_index % len(self.image_names)]
+        self.image_index += 1
+        return name
+
+    def place_item(self, name = None):
+        with self.lock:
+            self.item = name or self.next_image_name()
+            self.item_dropped.clear()
+            self.n_placed += 1
+            return self.item
+
+    def update(self):
+        # Item falls once the platform or the chute moves away from home
+        with self.lock:
+            if self.item is not None and (self.top.tilted() or self.bottom.front_open()):
+                self.item = None
+                self.n_dropped += 1
+                self.item_dropped.set()
+
+    def ready_for_item(self):
+        with self.lock:
+            self.update()
+            # Chute may stay turned to the counter side between items of the same bin
+            return self.item is None and self.top.at_home() and not self.bottom.front_open() and not self.bottom.moving()
+
+    def distance(self):
+        with self.lock:
+            if self.trace:
+                dist = self.trace[self.trace_index % len(self.trace)]
+                self.trace_index += 1
+            else:
+                dist = random.gauss(self.baseline, self.noise)
+            if self.item is not None:
+                dist -= self.item_height
+            return dist
+
+    def fire_echo(self):
+        # Echo pin goes high shortly after trigger, for the time sound needs to go there and back
+        rise = time.monotonic() + 0.0002
+        fall = rise + 2 * self.distance() / SPEED_SOUND
+        self.echo = (rise, fall)
+        return rise, fall
+
+    def pin_input(self, pin):
+        self.update()
+        if pin == self.pins['echo']:
+            if self.echo_level is not None:
+                return self.echo_level
+            rise, fall = self.echo
+            return int(rise <= time.monotonic() < fall)
+        if pin == self.pins['ir']:
+            # Low when there is an object
+            return int(self.item is None)
+        if pin == self.pins['door']:
+            # Pulled up, circuit closes at home
+            return int(not self.top.at_home())
+        return 0
+
+    def set_duty(self, pin, duty):
+        if pin == self.pins['top_servo']:
+            self.top.set_duty(duty)
+        elif pin == self.pins['bottom_servo']:
+            self.bottom.set_duty(duty)
+
+class SimPWM:
+    def __init__(self, world, pin, frequency):
+        self.world = world
+        self.pin = pin
+        self.frequency = frequency
+
+    def start(self, duty):
+        self.world.set_duty(self.pin, duty)
+
+    def ChangeDutyCycle(self, duty):
+        self.world.set_duty(self.pin, duty)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self.world.set_duty(self.pin, 0)
+
+# Same interface as RPi.GPIO, for the parts this project uses
+class SimGPIO:
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, world, poll_interval = 0.001):
+        self.world = world
+        self.poll_interval = poll_interval
+        self.outputs = {}
+        self.callbacks = {}
+        self.levels = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down = None, initial = None):
+        if direction == self.OUT:
+            self.outputs[pin] = initial or 0
+
+    def cleanup(self, *args):
+        self.callbacks.clear()
+
+    def output(self, pin, value):
+        was_high = self.outputs.get(pin, 0)
+        self.outputs[pin] = int(bool(value))
+        # Falling edge of trigger starts a ping
+        if pin == self.world.pins['trigger'] and was_high and not value:
+            rise, fall = self.world.fire_echo()
+            if self.world.pins['echo'] in self.callbacks:
+                threading.Thread(target = self.echo_pulse, args = (rise, fall), daemon = True).start()
+
+    def input(self, pin):
+        if pin in self.outputs:
+            return self.outputs[pin]
+        return self.world.pin_input(pin)
+
+    def PWM(self, pin, frequency):
+        return SimPWM(self.world, pin, frequency)
+
+    def add_event_detect(self, pin, edge, callback = None, bouncetime = None):
+        with self.lock:
+            self.callbacks[pin] = (edge, callback)
+            self.levels[pin] = self.world.pin_input(pin)
+        if self.thread is None:
+            self.thread = threading.Thread(target = self.poll_edges, name = "sim-gpio", daemon = True)
+            self.thread.start()
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.callbacks.pop(pin, None)
+            self.levels.pop(pin, None)
+
+    def echo_pulse(self, rise, fall):
+        # Edge callbacks for the echo pin, pulse is too short for poll_edges
+        echo_pin = self.world.pins['echo']
+        time.sleep(max(0.0, rise - time.monotonic()))
+        self.world.echo_level = 1
+        self.fire(echo_pin, 1)
+        time.sleep(max(0.0, fall - time.monotonic()))
+        self.world.echo_level = 0
+        self.fire(echo_pin, 0)
+
+    def fire(self, pin, level):
+        edge, callback = self.callbacks.get(pin, (None, None))
+        if callback is None:
+            return
+        if edge == self.BOTH or (edge == self.RISING and level) or (edge == self.FALLING and not level):
+            callback(pin)
+
+    def poll_edges(self):
+        while True:
+            with self.lock:
+                pins = [pin for pin in self.levels if pin != self.world.pins['echo']]
+            for pin in pins:
+                level = self.world.pin_input(pin)
+                if level != self.levels.get(pin, level):
+                    self.levels[pin] = level
+                    self.fire(pin, level)
+            time.sleep(self.poll_interval)
+
+# Camera replaying saved images, the item on the platform decides which one
+class Picamera2:
+    # Seconds spent reconfiguring the sensor on switch_mode
+    switch_time = 0.15
+    frame_rate = 30
+
+    def __init__(self, camera_num = 0):
+        self.world = world
+        self.config = None
+        self.started = False
+        self.overlay = None
+        self.frame_cache = {}
+
+    def make_config(self, main, lores, display, main_format, main_size, **kwargs):
+        config = {
+            'main' : {'format' : main_format, 'size' : main_size, **(main or {})},
+            'lores' : None,
+            'display' : display,
+            'transform' : None,
+            }
+        if lores is not None:
+            config['lores'] = {'format' : 'YUV420', 'size' : (320, 240), **lores}
+        config.update(kwargs)
+        return config
+
+    def create_still_configuration(self, main = {}, lores = None, display = None, **kwargs):
+        return self.make_config(main, lores, display, 'BGR888', (4056, 3040), **kwargs)
+
+    def create_preview_configuration(self, main = {}, lores = None, display = 'main', **kwargs):
+        return self.make_config(main, lores, display, 'XBGR8888', (640, 480), **kwargs)
+
+    def create_video_configuration(self, main = {}, lores = None, display = 'main', **kwargs):
+        return self.make_config(main, lores, display, 'XBGR8888', (1280, 720), **kwargs)
+
+    def configure(self, config):
+        self.config = config
+
+    def start_preview(self, preview = None):
+        pass
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def switch_mode(self, config):
+        time.sleep(self.switch_time)
+        self.config = config
+
+    def wait_frame(self):
+        # Next frame arrives on the frame clock
+        period = 1 / self.frame_rate
+        time.sleep(period - time.monotonic() % period)
+
+    def rgb_frame(self, size):
+        name = self.world.item
+        key = (name, tuple(size))
+        if key not in self.frame_cache:
+            if name is None:
+                # Empty platform
+                frame = np.full((size[1], size[0], 3), 90, dtype=np.uint8)
+            else:
+                with Image.open(f"{self.world.img_path}/{name}") as image:
+                    frame = np.asarray(image.convert('RGB').resize(tuple(size)))
+            if len(self.frame_cache) > 32:
+                self.frame_cache.clear()
+            self.frame_cache[key] = frame
+        return self.frame_cache[key]
+
+    def capture_array(self, name = "main"):
+        self.wait_frame()
+        return self.stream_array(name)
+
+    def capture_arrays(self, names = ["main"]):
+        # Every stream of the same frame, metadata is empty
+        self.wait_frame()
+        return [self.stream_array(name) for name in names], {}
+
+    def stream_array(self, name):
+        import cv2
+        stream = self.config[name]
+        frame = self.rgb_frame(stream['size'])
+        if stream['format'] == 'BGR888':
+            return frame.copy()
+        if stream['format'] == 'RGB888':
+            return frame[:, :, ::-1].copy()
+        if stream['format'] == 'XBGR8888':
+            return cv2.cvtColor(frame, cv2.COLOR_RGB2RGBA)
+        if stream['format'] == 'XRGB8888':
+            return cv2.cvtColor(frame, cv2.COLOR_RGB2BGRA)
+        return cv2.cvtColor(frame, cv2.COLOR_RGB2YUV_I420)
+
+    def capture_image(self, name = "main"):
+        self.wait_frame()
+        return Image.fromarray(self.rgb_frame(self.config[name]['size']))
+
+    def set_overlay(self, overlay):
+        self.overlay = overlay
+
+    def close(self):
+        self.stop()
+
+Preview = types.SimpleNamespace(QTGL = 'QTGL', QT = 'QT', DRM = 'DRM', NULL = 'NULL')
+libcamera = types.SimpleNamespace(Transform = lambda **kwargs: dict(kwargs))
+
+# I2C bus at 400 kHz, 9 clock per byte
+class SimI2CDevice:
+    def __init__(self, frequency = 400000):
+        self.frequency = frequency
+        self.n_bytes = 0
+        self.n_writes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def write(self, buffer, start = 0, end = None):
+        n = len(buffer[start:end])
+        self.n_bytes += n
+        self.n_writes += 1
+        time.sleep(n * 9 / self.frequency)
+
+# Same interface as adafruit_ssd1306.SSD1306_I2C, frame goes nowhere
+class SSD1306_I2C:
+    def __init__(self, width, height, i2c, addr = 0x3C, reset = None, external_vcc = False, page_addressing = False):
+        self.width = width
+        self.height = height
+        self.pages = height // 8
+        self.page_addressing = page_addressing
+        self.i2c_device = SimI2CDevice()
+        # First byte is the data control byte, like the real driver
+        self.buffer = bytearray(self.pages * width + 1)
+        self.buffer[0] = 0x40
+
+    def fill(self, color):
+        self.buffer[1:] = (b'\xff' if color else b'\x00') * (len(self.buffer) - 1)
+
+    def image(self, image):
+        # Vertical bytes, bit k of page p is row p * 8 + k
+        pixels = np.asarray(image.convert('1'), dtype=bool).reshape(self.pages, 8, self.width)
+        self.buffer[1:] = np.packbits(pixels, axis=1, bitorder='little').tobytes()
+
+    def write_cmd(self, cmd):
+        with self.i2c_device:
+            self.i2c_device.write(bytes([0x80, cmd]))
+
+    def write_framebuf(self):
+        with self.i2c_device:
+            self.i2c_device.write(self.buffer)
+
+    def show(self):
+        # Column and page address commands, then the whole frame
+        for cmd in (0x21, 0, self.width - 1, 0x22, 0, self.pages - 1):
+            self.write_cmd(cmd)
+        self.write_framebuf()
+
+board = types.SimpleNamespace(D4 = 4, I2C = lambda: None)
+digitalio = types.SimpleNamespace(DigitalInOut = lambda pin: pin)
+adafruit_ssd1306 = types.SimpleNamespace(SSD1306_I2C = SSD1306_I2C)
+
+# Replays the predictions recorded in img_metadata.csv for the item on the platform
+# Same interface as classify.ImageClassifier, for when there is no model or no tensorflow
+class SimClassifier:
+    def __init__(self, csv_path = None, size = (224, 224)):
+        self.world = world
+        self.size = size
+        self.rows = {}
+        with open(csv_path or world.csv_path, newline = '') as f:
+            for row in csv.DictReader(f):
+                self.rows[row['name']] = row
+
+    def get_input_shape(self):
+        return self.size
+
+    def classify_image(self, image):
+        row = self.rows.get(self.world.item)
+        if row is None:
+            row = next(iter(self.rows.values()))
+        # Take as long as the recorded classification did
+        pred_time = float(row['classifying_time_ms'])
+        time.sleep(pred_time)
+        return {
+            'category' : row['pred_category'],
+            'sub_category' : row['pred_subcategory'],
+            'probability' : float(row['probability']),
+            'time' : pred_time,
+            }
+
+world = World()
+GPIO = SimGPIO(world)
@@ -0,0 +1,137 @@
+import argparse
+import time
+import os
+
+import prediction_log
+
+# Saved images in shard folders under one root, with a byte budget
+# shard 'date' : root/2024-05-01/image-12.jpeg, one folder per day
+# shard 'count' : root/00000/image-12.jpeg, shard_size images per folder by image index
+# Once the images take more than budget bytes, the first ones of the eviction policy are deleted
+# down to low_watermark * budget, and flagged evicted in the prediction log
+class ImageStore:
+    def __init__(self, root, budget = None, policy = 'oldest', shard = 'date', shard_size = 1000, low_watermark = 0.9):
+        if shard not in ('date', 'count'):
+            raise ValueError(f"Shard '{shard}' is not valid")
+        if policy not in ('oldest', 'low_value'):
+            raise ValueError(f"Policy '{policy}' is not valid")
+        self.root = root
+        self.budget = budget
+        self.policy = policy
+        self.shard = shard
+        self.shard_size = shard_size
+        self.low_watermark = low_watermark
+        self.n_evicted = 0
+
+        if not os.path.exists(root):
+            os.makedirs(root)
+        # Walk once at startup, then kept up to date on every save and eviction
+        self.total_bytes = sum(os.path.getsize(path) for path in walk_images(root, full_path = True))
+
+    def shard_dir(self, name):
+        if self.shard == 'date':
+            return time.strftime("%Y-%m-%d")
+        index = prediction_log.image_index(name) or 0
+        return f"{index // self.shard_size:05d}"
+
+    def save(self, image, name):
+        # Returns the path relative to root, to keep in the prediction log
+        shard_dir = self.shard_dir(name)
+        if not os.path.exists(f"{self.root}/{shard_dir}"):
+            os.makedirs(f"{self.root}/{shard_dir}")
+        path = f"{shard_dir}/{name}"
+        image.save(f"{self.root}/{path}")
+        self.total_bytes += os.path.getsize(f"{self.root}/{path}")
+        return path
+
+    def over_budget(self):
+        return self.budget is not None and self.total_bytes > self.budget
+
+    def enforce_budget(self, log):
+        # Delete images until back under the low watermark, returns how many went
+        if not self.over_budget():
+            return 0
+        target = self.budget * self.low_watermark
+        n_evicted = 0
+        while self.total_bytes > target:
+            candidates = log.eviction_candidates(self.policy)
+            if not candidates:
+                break
+            evicted = []
+            for image_id, path in candidates:
+                full_path = f"{self.root}/{path}"
+                try:
+                    self.total_bytes -= os.path.getsize(full_path)
+                    os.remove(full_path)
+                except FileNotFoundError:
+                    pass
+                evicted.append(image_id)
+                self.remove_empty_shard(os.path.dirname(full_path))
+                if self.total_bytes <= target:
+                    break
+            log.mark_evicted(evicted)
+            n_evicted += len(evicted)
+        self.n_evicted += n_evicted
+        return n_evicted
+
+    def remove_empty_shard(self, directory):
+        # The shard may already be gone, removed by hand along with its images
+        if os.path.normpath(directory) == os.path.normpath(self.root) or not os.path.isdir(directory):
+            return
+        if not os.listdir(directory):
+            os.rmdir(directory)
+
+# Images under root, flat or in shards, relative to root unless full_path
+def walk_images(root, full_path = False):
+    paths = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if name.endswith((".jpeg", ".jpg")):
+                path = os.path.join(directory, name)
+                paths.append(path if full_path else os.path.relpath(path, root))
+    return paths
+
+# Sort key of saving order (image-0, image-1, ...), names without an index last
+def archive_order(path):
+    index = prediction_log.image_index(path)
+    return (index is None, index or 0, path)
+
+# Relative paths in saving order
+def list_images(root):
+    return sorted(walk_images(root), key = archive_order)
+
+# Move flat images into shards and record their paths, then apply the budget
+def main():
+    parser = argparse.ArgumentParser(description = "Shard saved images and apply the disk budget")
+    parser.add_argument("--img-path", default = "classified-image/images")
+    parser.add_argument("--db", default = "classified-image/predictions.db")
+    parser.add_argument("--budget-mb", type = float, default = None)
+    parser.add_argument("--policy", default = 'oldest', choices = ['oldest', 'low_value'])
+    parser.add_argument("--shard", default = 'date', choices = ['date', 'count'])
+    args = parser.parse_args()
+
+    log = prediction_log.PredictionLog(args.db)
+    budget = int(args.budget_mb * 1024 * 1024) if args.budget_mb else None
+    store = ImageStore(args.img_path, budget, args.policy, args.shard)
+
+    # Old images keep the day they were saved, not today
+    moved = []
+    for image_id, name, path in log.conn.execute("SELECT id, name, path FROM predictions WHERE evicted = 0 AND path IS NULL").fetchall():
+        if not os.path.exists(f"{args.img_path}/{name}"):
+            continue
+        if args.shard == 'date':
+            shard_dir = time.strftime("%Y-%m-%d", time.localtime(os.path.getmtime(f"{args.img_path}/{name}")))
+        else:
+            shard_dir = store.shard_dir(name)
+        os.makedirs(f"{args.img_path}/{shard_dir}", exist_ok = True)
+        os.replace(f"{args.img_path}/{name}", f"{args.img_path}/{shard_dir}/{name}")
+        moved.append((f"{shard_dir}/{name}", image_id))
+    with log.conn:
+        log.conn.executemany("UPDATE predictions SET path = ? WHERE id = ?", moved)
+
+    n_evicted = store.enforce_budget(log)
+    print(f"Moved {len(moved)} images to shards, evicted {n_evicted}, {store.total_bytes / 1024 / 1024:.1f} MB in {args.img_path}")
+    log.close()
+
+if __name__ == "__main__":
+    main()
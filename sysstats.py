@@ -0,0 +1,103 @@
+import time
+
+# CPU, memory and SoC temperature read straight from /proc and /sys, no subprocess
+# Files stay open, every sample is a seek + read of a few hundred bytes
+# CPU usage is the difference with the counters of the previous sample
+class SysStats:
+    def __init__(self, stat_path = "/proc/stat", meminfo_path = "/proc/meminfo",
+                 thermal_path = "/sys/class/thermal/thermal_zone0/temp", min_interval = 0.5):
+        self.stat_file = open_or_none(stat_path)
+        self.meminfo_file = open_or_none(meminfo_path)
+        self.thermal_file = open_or_none(thermal_path)
+        # Calls closer than this return the last sample, CPU usage over a few ms is only noise
+        self.min_interval = min_interval
+
+        self.last_busy = None
+        self.last_total = None
+        self.last_time = None
+        self.last_sample = None
+
+        # First counters, so the first sample already has a CPU usage
+        self.read_cpu()
+        self.last_time = time.monotonic()
+
+    def read_cpu(self):
+        # cpu  user nice system idle iowait irq softirq steal ...
+        if self.stat_file is None:
+            return None
+        self.stat_file.seek(0)
+        fields = self.stat_file.readline().split()[1:]
+        values = [int(value) for value in fields[:8]]
+        idle = values[3] + values[4]
+        total = sum(values)
+        busy = total - idle
+
+        percent = None
+        if self.last_total is not None and total > self.last_total:
+            percent = 100 * (busy - self.last_busy) / (total - self.last_total)
+        self.last_busy = busy
+        self.last_total = total
+        return percent
+
+    def read_memory(self):
+        # Same as used / total of free : everything not available to new programs
+        if self.meminfo_file is None:
+            return None
+        self.meminfo_file.seek(0)
+        info = {}
+        for line in self.meminfo_file:
+            key, value = line.split(':', 1)
+            if key in ('MemTotal', 'MemAvailable'):
+                info[key] = int(value.split()[0])
+                if len(info) == 2:
+                    break
+        if 'MemTotal' not in info or 'MemAvailable' not in info:
+            return None
+        return 100 * (info['MemTotal'] - info['MemAvailable']) / info['MemTotal']
+
+    def read_temperature(self):
+        # Millidegree celsius
+        if self.thermal_file is None:
+            return None
+        self.thermal_file.seek(0)
+        try:
+            return int(self.thermal_file.read().strip()) / 1000
+        except (OSError, ValueError):
+            return None
+
+    def sample(self):
+        now = time.monotonic()
+        if self.last_sample is not None and now - self.last_time < self.min_interval:
+            return self.last_sample
+        self.last_sample = {
+            'cpu' : self.read_cpu(),
+            'memory' : self.read_memory(),
+            'temperature' : self.read_temperature(),
+            }
+        self.last_time = now
+        return self.last_sample
+
+    def close(self):
+        for f in (self.stat_file, self.meminfo_file, self.thermal_file):
+            if f is not None:
+                f.close()
+
+def open_or_none(path):
+    try:
+        return open(path)
+    except OSError:
+        return None
+
+# Just for testing
+def main():
+    stats = SysStats()
+    for _ in range(5):
+        time.sleep(1)
+        time1 = time.perf_counter()
+        sample = stats.sample()
+        time2 = time.perf_counter()
+        print(sample, f"{(time2 - time1) * 1e6:.0f} us")
+    stats.close()
+
+if __name__ == "__main__":
+    main()
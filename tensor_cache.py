@@ -0,0 +1,158 @@
+from PIL import Image
+import numpy as np
+import argparse
+import json
+import time
+import os
+from multiprocessing import Pool
+
+import classify
+import storage
+
+# Model ready inputs of the image archive in one uint8 file, read through a memory map
+# One file per model input shape : tensors_{h}x{w}.u8 holds rows of (h, w, 3),
+# tensors_{h}x{w}.json maps image name to [row, mtime_ns, size] of the jpeg it came from
+# New images are appended, changed ones are written again in place, so update only decodes what is new
+# Rows of evicted images are free and taken first by new images, the file follows the archive's disk budget
+class TensorCache:
+    def __init__(self, cache_dir, shape):
+        self.cache_dir = cache_dir
+        self.height, self.width = shape
+        self.row_shape = (self.height, self.width, 3)
+        self.row_bytes = self.height * self.width * 3
+        self.data_path = f"{cache_dir}/tensors_{self.height}x{self.width}.u8"
+        self.index_path = f"{cache_dir}/tensors_{self.height}x{self.width}.json"
+        self.entries = {}
+        self.n_rows = 0
+        self.free = []
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.entries = index['entries']
+            self.n_rows = index['n_rows']
+            self.free = index.get('free', [])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def row(self, name):
+        return self.entries[name][0]
+
+    def save_index(self):
+        # Written after the rows, a reader never sees a row that isn't there yet
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'shape' : list(self.row_shape), 'n_rows' : self.n_rows, 'free' : self.free, 'entries' : self.entries}, f)
+        os.replace(temp_path, self.index_path)
+
+    def update(self, img_path, workers = None, chunk = 64):
+        # Images missing from the cache, or changed since they were cached
+        names = []
+        stats = {}
+        # Names are paths relative to img_path, images may sit in shard folders
+        for name in storage.walk_images(img_path):
+            stat = os.stat(f"{img_path}/{name}")
+            stats[name] = [stat.st_mtime_ns, stat.st_size]
+            entry = self.entries.get(name)
+            if entry is None or entry[1:] != stats[name]:
+                names.append(name)
+        names.sort(key = storage.archive_order)
+
+        # Images gone from the archive (evicted), their rows go to new images
+        removed = [name for name in self.entries if name not in stats]
+        for name in removed:
+            self.free.append(self.entries.pop(name)[0])
+        # Lowest free row first, the end of the file is freed last and can be cut off
+        self.free.sort(reverse = True)
+
+        if names:
+            # Creates the file on first run, r+b allows writing changed rows in place
+            open(self.data_path, 'ab').close()
+            size = (self.width, self.height)
+            with Pool(workers) as pool, open(self.data_path, 'r+b') as f:
+                tasks = ((img_path, name, size) for name in names)
+                for i, (name, tensor) in enumerate(pool.imap(load_tensor, tasks, chunksize = 8)):
+                    entry = self.entries.get(name)
+                    if entry is not None:
+                        row = entry[0]
+                    elif self.free:
+                        row = self.free.pop()
+                    else:
+                        row = self.n_rows
+                        self.n_rows += 1
+                    f.seek(row * self.row_bytes)
+                    f.write(tensor.tobytes())
+                    self.entries[name] = [row] + stats[name]
+                    # Save progress now and then, an interrupted update keeps what it did
+                    if (i + 1) % chunk == 0:
+                        f.flush()
+                        self.save_index()
+        if removed:
+            self.trim()
+        if names or removed:
+            self.save_index()
+        return len(names), len(removed)
+
+    def trim(self):
+        # Free rows at the end of the file are cut off
+        free = set(self.free)
+        n_rows = self.n_rows
+        while n_rows - 1 in free:
+            n_rows -= 1
+            free.remove(n_rows)
+        if n_rows < self.n_rows and os.path.exists(self.data_path):
+            self.free = sorted(free, reverse = True)
+            self.n_rows = n_rows
+            # Index first, it never points past the end of the file
+            self.save_index()
+            os.truncate(self.data_path, n_rows * self.row_bytes)
+
+    def open(self):
+        # Read only map of every row, pages are loaded by the OS when touched
+        if self.n_rows == 0:
+            return np.empty((0, *self.row_shape), dtype=np.uint8)
+        return np.memmap(self.data_path, dtype=np.uint8, mode='r', shape=(self.n_rows, *self.row_shape))
+
+    def names(self):
+        # Cached images in archive order
+        return sorted(self.entries, key = storage.archive_order)
+
+# Decode one archived image, same preprocessing as the main loop
+# args : (img_path, name, size), returns (name, uint8 array), for Pool.imap
+def load_tensor(args):
+    img_path, name, size = args
+    with Image.open(f"{img_path}/{name}") as image:
+        image = classify.preprocess_img(image.convert('RGB'), size)
+        return name, np.asarray(image, dtype=np.uint8)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Build or update the preprocessed tensor cache of the image archive")
+    parser.add_argument("--img-path", default = "classified-image/images")
+    parser.add_argument("--cache-dir", default = "classified-image/tensor-cache")
+    parser.add_argument("--size", type = int, nargs = 2, default = [224, 224], metavar = ("HEIGHT", "WIDTH"))
+    parser.add_argument("--workers", type = int, default = None, help = "Default : number of CPUs")
+    args = parser.parse_args()
+
+    cache = TensorCache(args.cache_dir, args.size)
+    time1 = time.perf_counter()
+    n_updated, n_removed = cache.update(args.img_path, args.workers)
+    time2 = time.perf_counter()
+    print(f"{n_updated} images cached, {n_removed} removed in {np.round(time2 - time1, 3)} s, {len(cache)} in cache")
+
+    # Full pass over the map, what every offline tool pays instead of decoding
+    time1 = time.perf_counter()
+    tensors = cache.open()
+    total = 0.0
+    for name in cache.names():
+        total += tensors[cache.row(name)].mean()
+    time2 = time.perf_counter()
+    print(f"Read {len(cache)} tensors in {np.round(time2 - time1, 3)} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import numpy as np
+
+import camera
+import classify
+
+def yuv420(luma):
+    # Y plane on top of flat U and V planes
+    h, w = luma.shape
+    return np.vstack([luma, np.full((h // 2, w), 128, dtype=np.uint8)])
+
+def test_crisp_frame_outscores_blurred_copy():
+    # 0 / 255 checkerboard, the steepest edges a frame can have
+    crisp = (np.indices((64, 64)).sum(axis=0) // 8 % 2 * 255).astype(np.uint8)
+    # Box blur of the same frame
+    padded = np.pad(crisp.astype(np.float32), 2, mode='edge')
+    blurred = sum(padded[y:y + 64, x:x + 64] for y in range(5) for x in range(5)) / 25
+    blurred = blurred.astype(np.uint8)
+
+    ring = camera.FrameRing(2, (64, 64), (64, 64), step = 1)
+    ring.add(crisp, yuv420(crisp))
+    ring.add(blurred, yuv420(blurred))
+
+    assert ring.sharpness[0] > ring.sharpness[1] > 0
+
+def test_pipeline_captures_directly_when_ring_has_no_frame():
+    import main
+
+    class EmptyRingCamera:
+        frame_ring = object()
+        def capture_best(self, trigger_time):
+            return None
+        def capture_array(self):
+            return np.full((16, 16, 3), 200, dtype=np.uint8)
+
+    class StillSensor:
+        def check_distance(self):
+            return 10.0
+
+    class Classifier:
+        def classify_image(self, image):
+            return {'mean' : float(np.mean(image))}
+
+    pipeline = main.Pipeline(None, StillSensor(), None, EmptyRingCamera(), None, Classifier(),
+                             classify.ArrayPreprocessor((8, 8)), None)
+    img, result = pipeline.capture_and_classify(0, 0.0)
+
+    assert result['mean'] == 200
+    assert pipeline.tracer.counters['capture_fallbacks'] == 1
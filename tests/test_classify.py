@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+import classify
+
+def test_classify_image_with_batch_model(model_path):
+    img_classifier = classify.ImageClassifier(path = model_path, batch_size = 4)
+    bright = np.full((8, 8, 3), 230, dtype=np.uint8)
+
+    result = img_classifier.classify_image(bright)
+
+    assert result['sub_category'] == "Bright"
+    assert result['category'] == "Daur Ulang"
+    assert [r['sub_category'] for r in img_classifier.classify_batch([bright, np.zeros_like(bright)])] == ["Bright", "Dark"]
+
+def i420(y, u, v, pad = 0):
+    # Planes in one array, every row padded with pad garbage columns (stride)
+    h, w = y.shape
+    stride = w + pad
+    pad_rows = lambda plane, width: np.pad(plane, ((0, 0), (0, width - plane.shape[1])), constant_values = 255)
+    return np.vstack([
+        pad_rows(y, stride),
+        pad_rows(u, stride // 2).reshape(h // 4, stride),
+        pad_rows(v, stride // 2).reshape(h // 4, stride),
+        ])
+
+def test_yuv420_height_not_multiple_of_4():
+    frame = np.zeros((375, 300), dtype=np.uint8)
+    with pytest.raises(ValueError, match = "multiple of 4"):
+        classify.ArrayPreprocessor((64, 64), 'YUV420').process(frame)
+    with pytest.raises(ValueError, match = "multiple of 4"):
+        classify.ArrayPreprocessor((64, 64), 'YUV420', frame_size = (300, 250))
+
+def test_yuv420_stride_padding_is_left_out():
+    rng = np.random.default_rng(0)
+    y = rng.integers(0, 256, (96, 128), dtype=np.uint8)
+    u = rng.integers(0, 256, (48, 64), dtype=np.uint8)
+    v = rng.integers(0, 256, (48, 64), dtype=np.uint8)
+
+    expected = classify.ArrayPreprocessor((32, 32), 'YUV420').process(i420(y, u, v)).copy()
+    padded = classify.ArrayPreprocessor((32, 32), 'YUV420', frame_size = (128, 96)).process(i420(y, u, v, pad = 32))
+
+    assert np.array_equal(padded, expected)
+
+def test_cascade_prepares_images_for_largest_stage(model_path):
+    with open(f"{model_path}/large.tflite", 'w') as f:
+        f.write("16")
+    # Threshold 1 : every image goes on to the second stage
+    img_classifier = classify.ImageClassifier(path = model_path, model_name = ["model.tflite", "large.tflite"], thresholds = 1.0)
+    assert img_classifier.get_input_shape() == (16, 16)
+
+    # One pixel stripes, lost if the large stage got an upsampled 8x8 image
+    image = np.zeros((16, 16, 3), dtype=np.uint8)
+    image[:, ::2] = 255
+    result = img_classifier.classify_image(image)
+
+    assert result['stage'] == 1
+    assert np.array_equal(img_classifier.stages[1].models[0].interpreter.input[0], image)
@@ -0,0 +1,41 @@
+import http.client
+import json
+
+import numpy as np
+
+import classify
+import inference_server
+
+def test_batcher_with_interpreter_classifier(model_path):
+    img_classifier = classify.ImageClassifier(path = model_path, batch_size = 4)
+    batcher = inference_server.DynamicBatcher(img_classifier, max_batch = 4, max_delay = 0.05)
+    try:
+        images = [np.full((8, 8, 3), value, dtype=np.uint8) for value in (230, 10, 200, 20)]
+        futures = [batcher.submit(image) for image in images]
+        results = [future.result(5) for future in futures]
+    finally:
+        batcher.close()
+
+    assert [result['sub_category'] for result in results] == ["Bright", "Dark", "Bright", "Dark"]
+    assert batcher.stats()['images'] == 4
+    assert batcher.stats()['batches'] < 4
+
+def test_bad_requests_are_rejected_before_batching(model_path):
+    img_classifier = classify.ImageClassifier(path = model_path, batch_size = 4)
+    server = inference_server.InferenceServer(img_classifier, port = 0, host = "127.0.0.1", max_batch = 4)
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout = 5)
+    try:
+        for shape, body in (("192", bytes(192)), ("8,8,4", bytes(256)), ("8,8,3", bytes(100))):
+            conn.request("POST", "/classify", body = body, headers = {"X-Shape" : shape})
+            response = conn.getresponse()
+            response.read()
+            assert response.status == 400
+        assert server.batcher.stats()['images'] == 0
+
+        conn.request("POST", "/classify", body = bytes(192), headers = {"X-Shape" : "8,8,3"})
+        response = conn.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read())['sub_category'] == "Dark"
+    finally:
+        conn.close()
+        server.close()
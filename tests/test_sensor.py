@@ -0,0 +1,20 @@
+import time
+
+import sensor
+
+def test_late_echo_callbacks_keep_ping_order(monkeypatch):
+    dist_sensor = sensor.DistanceSensor()
+
+    # Fall of a ping nobody waits for is ignored
+    dist_sensor.echo_edge(dist_sensor.GPIO_ECHO)
+    assert not dist_sensor.echo_event.is_set()
+
+    # 1.2 ms echo (about 20 cm) whose callbacks both run after the pin went low again
+    def send_trigger():
+        dist_sensor.echo_edge(dist_sensor.GPIO_ECHO)
+        time.sleep(0.0012)
+        dist_sensor.echo_edge(dist_sensor.GPIO_ECHO)
+    monkeypatch.setattr(dist_sensor, "send_trigger", send_trigger)
+    monkeypatch.setattr(sensor.GPIO, "input", lambda pin: 0)
+
+    assert 15 < dist_sensor.measure_edge() < 40
@@ -0,0 +1,51 @@
+import os
+import shutil
+
+import numpy as np
+from PIL import Image
+
+import prediction_log
+import storage
+
+# Four identical images in count shards of two : 00000 holds image-0 and 1, 00001 holds image-2 and 3
+def save_images(tmp_path, probabilities, budget, policy, low_watermark):
+    log = prediction_log.PredictionLog(str(tmp_path / "predictions.db"))
+    store = storage.ImageStore(str(tmp_path / "images"), None, policy, 'count', shard_size = 2, low_watermark = low_watermark)
+    image = Image.fromarray(np.full((16, 16, 3), 128, dtype=np.uint8))
+    for probability in probabilities:
+        name = log.next_name()
+        path = store.save(image, name)
+        log.append(name, {'category' : "Residu", 'sub_category' : "Other", 'probability' : probability, 'time' : 1.0}, path)
+    image_bytes = store.total_bytes / len(probabilities)
+    store.budget = int(image_bytes * budget)
+    return log, store, image_bytes
+
+def evicted_ids(log):
+    return [row[0] for row in log.conn.execute("SELECT id FROM predictions WHERE evicted = 1 ORDER BY id")]
+
+def test_oldest_policy_evicts_first_saved_and_removes_empty_shard(tmp_path):
+    log, store, image_bytes = save_images(tmp_path, [0.5] * 4, budget = 3, policy = 'oldest', low_watermark = 0.5)
+
+    assert store.enforce_budget(log) == 3
+    assert evicted_ids(log) == [0, 1, 2]
+    assert store.total_bytes == image_bytes
+    assert storage.list_images(store.root) == ["00001/image-3.jpeg"]
+    assert not os.path.exists(f"{store.root}/00000")
+
+def test_low_value_policy_evicts_most_confident_first(tmp_path):
+    log, store, _ = save_images(tmp_path, [0.9, 0.2, 0.8, 0.5], budget = 3.5, policy = 'low_value', low_watermark = 0.6)
+
+    assert store.enforce_budget(log) == 2
+    assert evicted_ids(log) == [0, 2]
+    assert storage.list_images(store.root) == ["00000/image-1.jpeg", "00001/image-3.jpeg"]
+
+def test_images_and_shard_removed_by_hand(tmp_path):
+    log, store, image_bytes = save_images(tmp_path, [0.5] * 4, budget = 3.5, policy = 'oldest', low_watermark = 0.9)
+    shutil.rmtree(f"{store.root}/00000")
+
+    # Missing images are marked evicted without freeing bytes, the next one brings it under the target
+    assert store.enforce_budget(log) == 3
+    assert evicted_ids(log) == [0, 1, 2]
+    assert store.total_bytes == 3 * image_bytes
+    assert storage.list_images(store.root) == ["00001/image-3.jpeg"]
+    assert not store.over_budget()
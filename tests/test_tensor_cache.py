@@ -0,0 +1,35 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+import tensor_cache
+
+def save_images(img_path, indexes):
+    for i in indexes:
+        Image.fromarray(np.full((16, 16, 3), i * 10, dtype=np.uint8)).save(f"{img_path}/image-{i}.jpeg")
+
+def test_rows_of_evicted_images_are_reused(tmp_path):
+    img_path = tmp_path / "images"
+    img_path.mkdir()
+    cache = tensor_cache.TensorCache(str(tmp_path / "cache"), (8, 8))
+    save_images(img_path, range(4))
+    cache.update(str(img_path), workers = 1)
+    assert cache.n_rows == 4
+
+    # Two evicted, two new : the file doesn't grow
+    os.remove(img_path / "image-0.jpeg")
+    os.remove(img_path / "image-1.jpeg")
+    save_images(img_path, [4, 5])
+    assert cache.update(str(img_path), workers = 1) == (2, 2)
+    assert cache.n_rows == 4
+    assert sorted(cache.row(name) for name in cache.names()) == [0, 1, 2, 3]
+    tensors = cache.open()
+    assert tensors[cache.row("image-5.jpeg")].mean() == np.float64(50)
+
+    # Free rows at the end are cut off, and survive a reload
+    os.remove(img_path / "image-3.jpeg")
+    cache.update(str(img_path), workers = 1)
+    cache = tensor_cache.TensorCache(str(tmp_path / "cache"), (8, 8))
+    assert os.path.getsize(cache.data_path) == cache.n_rows * cache.row_bytes
+    assert cache.names() == ["image-2.jpeg", "image-4.jpeg", "image-5.jpeg"]